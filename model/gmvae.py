@@ -6,11 +6,12 @@
 Gaussian Mixture Variational Autoencoder Networks
 
 """
+import warnings
 import torch
 import torch.nn.init as init
 from torch import nn
 from torch.nn import functional as F 
-from model.layers import GumbelSoftmax, Gaussian
+from model.layers import GumbelSoftmax, Gaussian, fold_layers
 
 
 # Inference Network
@@ -74,6 +75,38 @@ class InferenceNet(nn.Module):
               'logits': logits, 'prob_cat': prob, 'categorical': y}
     return output
 
+  def fold(self):
+    return FoldedInferenceNet(self)
+
+
+# Deterministic encoder for latent extraction
+class FoldedInferenceNet(nn.Module):
+  """Inference-only copy of InferenceNet with BatchNorm folded into Linear layers.
+
+  Returns the mean of q(z|x,y) instead of a reparameterised sample, and feeds
+  q(z|x,y) with the categorical probabilities instead of a gumbel sample, so
+  the output is deterministic. Skipping the variance head and GenerativeNet
+  leaves about 40% of the multiply-adds of a full GMVAENet pass.
+
+  Args:
+      inference (InferenceNet): trained network, its BatchNorm running
+          statistics are folded at construction time.
+  """
+  def __init__(self, inference):
+    super(FoldedInferenceNet, self).__init__()
+    self.qyx, self.qyx_logits = fold_layers(
+        list(inference.inference_qyx)[:-1], inference.inference_qyx[-1].logits)
+    self.qzyx, self.qzyx_mu = fold_layers(
+        list(inference.inference_qzyx)[:-1], inference.inference_qzyx[-1].mu)
+    self.eval()
+
+  def forward(self, x):
+    x = x.view(x.size(0), -1)
+    logits = self.qyx_logits(self.qyx(x))
+    prob = F.softmax(logits, dim=-1)
+    mu = self.qzyx_mu(self.qzyx(torch.cat((x, prob), dim=1)))
+    return mu, prob
+
 
 # Generative Network
 class GenerativeNet(nn.Module):
@@ -101,7 +134,7 @@ class GenerativeNet(nn.Module):
   # p(z|y)
   def pzy(self, y):
     y_mu = self.y_mu(y)
-    y_var = F.softplus(self.y_var(y))
+    y_var = F.softplus(self.y_var(y).float())
     return y_mu, y_var
   
   # p(x|z)
@@ -147,3 +180,66 @@ class GMVAENet(nn.Module):
     for key, value in out_gen.items():
       output[key] = value
     return output
+
+
+# Compiled execution of GMVAENet
+class CompiledGMVAENet:
+  """Runs a GMVAENet through torch.compile, falling back to a TorchScript trace.
+
+  torch.compile is used when available (torch >= 2.0). Otherwise the network is
+  traced lazily, once per train/eval mode since BatchNorm and Dropout behaviour
+  is frozen into the trace. If tracing fails the network runs eagerly.
+  Parameters and buffers are shared with `network`, so optimizer steps and
+  `load_state_dict` apply to the compiled version as well.
+
+  Args:
+      network (GMVAENet): network to compile.
+      backend (string): 'compile' for torch.compile with TorchScript fallback
+          (when unavailable or when it fails at run time), 'torchscript' to
+          always trace.
+  """
+  def __init__(self, network, backend='compile'):
+    self.network = network
+    self.backend = backend
+    self._compiled = None
+    self._traced = {}
+    if backend == 'compile':
+      if hasattr(torch, 'compile'):
+        self._compiled = torch.compile(network)
+      else:
+        self.backend = 'torchscript'
+
+  def trace(self, x):
+    # tracing runs one forward pass, keep the BatchNorm running stats untouched
+    buffers = {name: buf.clone() for name, buf in self.network.named_buffers()}
+    try:
+      traced = torch.jit.trace(self.network, x, strict=False, check_trace=False)
+    except Exception as e:
+      warnings.warn(f'TorchScript tracing failed, running GMVAENet eagerly: {e}')
+      traced = self.network
+    with torch.no_grad():
+      for name, buf in self.network.named_buffers():
+        buf.copy_(buffers[name])
+    return traced
+
+  def __call__(self, x):
+    if self._compiled is not None:
+      # torch.compile only fails once Dynamo/Inductor actually run (unsupported
+      # graph, missing C++ toolchain, recompilation on a new batch shape)
+      try:
+        return self._compiled(x)
+      except Exception as e:
+        warnings.warn(f'torch.compile failed, falling back to TorchScript: {e}')
+        self._compiled = None
+        self.backend = 'torchscript'
+    mode = self.network.training
+    if mode not in self._traced:
+      self._traced[mode] = self.trace(x)
+    try:
+      return self._traced[mode](x)
+    except Exception as e:
+      if self._traced[mode] is self.network:
+        raise
+      warnings.warn(f'TorchScript execution failed, running GMVAENet eagerly: {e}')
+      self._traced[mode] = self.network
+      return self.network(x)
@@ -1,10 +1,11 @@
 from operator import ne
 import wandb
+import torch
 import torch.nn as nn
 import numpy as np
 from torch.optim import Adam
 from sklearn.mixture import GaussianMixture
-from model.gmvae import GMVAENet
+from model.gmvae import GMVAENet, CompiledGMVAENet
 from model.losses import LossFunctions
 import zarr
 import os
@@ -18,6 +19,23 @@ from utils.utils import (
 )
 
 
+def complete_views(carry, rows, n_views):
+    """Groups consecutive rows into the complete views of each contig.
+
+    Args:
+        carry (np.ndarray): rows left over from the previous batch.
+        rows (np.ndarray): rows of the current batch, (B, ...).
+        n_views (int): number of consecutive rows per contig.
+
+    Returns:
+        views (np.ndarray): (M, n_views, ...) views of the completed contigs.
+        carry (np.ndarray): rows of a contig split across batches, for the next call.
+    """
+    rows = np.concatenate((carry, rows)) if len(carry) else rows
+    num_full = len(rows) // n_views * n_views
+    return rows[:num_full].reshape(-1, n_views, *rows.shape[1:]), rows[num_full:].copy()
+
+
 class DeepMetaBinModel(nn.Module):
     def __init__(
         self,
@@ -71,6 +89,7 @@ class DeepMetaBinModel(nn.Module):
 
         self.num_classes = 50
         
+        self.gaussian_size = gaussian_size
         self.network = GMVAENet(
             x_dim = input_size,
             z_dim = gaussian_size,
@@ -92,6 +111,7 @@ class DeepMetaBinModel(nn.Module):
         self.contig_path = contig_path
         self.count = 0
         self.epoch_list = []
+        self.compiled_network = None
 
     def unlabeled_loss(self, data, out_net):
         z, data_recon = out_net["gaussian"], out_net["x_rec"]
@@ -124,13 +144,66 @@ class DeepMetaBinModel(nn.Module):
 
     def forward(self):
         pass
+
+    def enable_compiled_execution(self, backend="compile"):
+        """Routes training and inference through a compiled GMVAENet.
+
+        Args:
+            backend (string): 'compile' (torch.compile, TorchScript fallback),
+                'torchscript', or 'none' to run eagerly.
+        """
+        if backend == "none":
+            self.compiled_network = None
+        else:
+            self.compiled_network = CompiledGMVAENet(self.network, backend=backend)
+        return self.compiled_network
+
+    def run_network(self, x):
+        if self.compiled_network is not None:
+            return self.compiled_network(x)
+        return self.network(x)
+
+    def inference_encoder(self):
+        """Builds the deterministic, BatchNorm-folded encoder of the current weights.
+
+        The encoder is a snapshot, build it once per inference pass and rebuild
+        it after further training.
+
+        Returns:
+            encoder (callable): maps features to (latent mean, prob_cat).
+        """
+        encoder = self.network.inference.fold()
+        if self.compiled_network is not None:
+            encoder = CompiledGMVAENet(encoder, backend=self.compiled_network.backend)
+        return encoder
+
+    def encode(self, x, return_prob=False, encoder=None):
+        """Encodes features into the latent space using only the inference network.
+
+        Args:
+            x (tensor): input features, dimension is (B, input_size).
+            return_prob (boolean): whether to also return prob_cat.
+            encoder (callable): prebuilt encoder from inference_encoder(), to avoid
+                refolding the weights for every batch.
+
+        Returns:
+            mean (tensor): mean of q(z|x,y), dimension is (B, gaussian_size).
+            prob_cat (tensor): categorical probabilities, if return_prob.
+        """
+        if encoder is None:
+            encoder = self.inference_encoder()
+        with torch.no_grad():
+            mean, prob_cat = encoder(x)
+        if return_prob:
+            return mean, prob_cat
+        return mean
         
     def training_step(self, batch, batch_idx):
         attributes = batch["feature"]
         # neighbor_attributes = batch["neighbors_feature"].squeeze()
         # neighbors_mask = batch["neighbors_feature_mask"].squeeze()
         # neighbors_weight = batch["neighbors_weight"].squeeze()
-        out_net = self.network(attributes)
+        out_net = self.run_network(attributes)
         loss_dict = self.unlabeled_loss(attributes, out_net)
 
         loss = loss_dict["total"]
@@ -164,11 +237,9 @@ class DeepMetaBinModel(nn.Module):
     def test_step(self):
         pass
     
-    def validation_step(self, batch):
+    def validation_step(self, batch, encoder=None):
         attributes = batch["feature"]
-        out_net = self.network(attributes)
-        prob_cat = out_net["prob_cat"]
-        latent = out_net["gaussian"]
+        latent, prob_cat = self.encode(attributes, return_prob=True, encoder=encoder)
         bin_tensor = prob_cat.argmax(-1)
         # gd_bin_list, result_bin_list, non_labeled_id_list = summary_bin_list_from_batch(batch, bin_tensor)
         # if self.current_epoch < 100:
@@ -185,21 +256,116 @@ class DeepMetaBinModel(nn.Module):
         # self.log("val/gmm_F1", 0.5, on_step=False, on_epoch=True, prog_bar=False)
 
         
-        # Save latent.
+        return {"latent": latent, "prob_cat": prob_cat, "bin": bin_tensor}
+
+    def save_latent(self, dataloader, n_views=1, pool_views="none", save_prob=False, categorical_bins=False):
+        """Streams the dataset through the encoder and writes latent.npy chunk by chunk.
+
+        latent.npy is preallocated as a memory-mapped array and every batch of the
+        (unshuffled) dataloader is written into its slice, so peak memory is bounded
+        by the dataloader batch size instead of the dataset size.
+
+        With pool_views, latent_pooled.npy additionally holds one row per contig,
+        row i pooling dataset rows i * n_views ... (i + 1) * n_views - 1 (the views
+        of contig i); views split across batches are carried to the next batch.
+
+        With save_prob, prob_cat.npy holds the categorical probabilities of every
+        row, e.g. to initialise fit_gmm.
+
+        With categorical_bins, categorical_bins.tsv bins every contig straight from
+        the categorical head, at no extra inference cost: prob_cat is averaged over
+        the views of the contig, and each line holds the contig name (view 0), the
+        argmax bin, its probability and the entropy (nats) of the averaged
+        distribution. Low probability / high entropy contigs are the uncertain ones.
+
+        Args:
+            dataloader (DataLoader): unshuffled loader over the whole dataset.
+            n_views (int): number of consecutive rows (views) per contig.
+            pool_views (string): 'mean' of the views, 'first' (view 0) or 'none'.
+            save_prob (boolean): whether to also write prob_cat.npy.
+            categorical_bins (boolean): whether to also write categorical_bins.tsv.
+
+        Returns:
+            result_path (string): path of the written latent.npy.
+        """
         # result_path = "{}/latent_{}_{}".format(self.result_path, self.current_epoch, self.global_step)
         result_path = "{}/latent.npy".format(self.result_path)
-        latent_feature = latent.numpy()
-        np.save(result_path, latent_feature)
-        # latent = np.load(args.latent_path)
-        contignames = np.load(self.contignames_path)['arr_0']
-        # contignames = np.squeeze(contignames)
-        contignames = contignames.tolist()
-        # mask = np.load(mask_path)
-        # mask = mask['arr_0']
-        # contignames = ['NODE_'+str(m) for m in contignames]
+        num_samples = len(dataloader.dataset)
+        latent_file = np.lib.format.open_memmap(
+            result_path, mode="w+", dtype=np.float32, shape=(num_samples, self.gaussian_size))
+        pooled_file = None
+        if pool_views != "none":
+            if num_samples % n_views:
+                raise ValueError(f"{num_samples} samples are not a multiple of n_views={n_views}")
+            pooled_file = np.lib.format.open_memmap(
+                self.pooled_latent_path(), mode="w+", dtype=np.float32,
+                shape=(num_samples // n_views, self.gaussian_size))
+            carry = np.empty((0, self.gaussian_size), dtype=np.float32)
+            pooled_start = 0
+        prob_file = None
+        if save_prob:
+            prob_file = np.lib.format.open_memmap(
+                self.prob_cat_path(), mode="w+", dtype=np.float32, shape=(num_samples, self.num_classes))
+        bins_file = None
+        if categorical_bins:
+            if num_samples % n_views:
+                raise ValueError(f"{num_samples} samples are not a multiple of n_views={n_views}")
+            contignames = np.load(self.contignames_path)["arr_0"][::n_views]
+            if len(contignames) != num_samples // n_views:
+                raise ValueError(f"{self.contignames_path} holds {len(contignames)} contigs, "
+                                 f"expected {num_samples // n_views}")
+            bins_file = open(self.categorical_bins_path(), "w")
+            prob_carry = np.empty((0, self.num_classes), dtype=np.float32)
+            contig_start = 0
+        encoder = self.inference_encoder()
+        start = 0
+        for batch in dataloader:
+            output = self.validation_step(batch, encoder=encoder)
+            latent = output["latent"].numpy()
+            end = start + latent.shape[0]
+            latent_file[start:end] = latent
+            if prob_file is not None or bins_file is not None:
+                prob_cat = output["prob_cat"].float().numpy()
+            if prob_file is not None:
+                prob_file[start:end] = prob_cat
+            start = end
+            if pooled_file is not None:
+                views, carry = complete_views(carry, latent, n_views)
+                pooled = views.mean(axis=1) if pool_views == "mean" else views[:, 0]
+                pooled_file[pooled_start:pooled_start + len(pooled)] = pooled
+                pooled_start += len(pooled)
+            if bins_file is not None:
+                views, prob_carry = complete_views(prob_carry, prob_cat, n_views)
+                prob = views.mean(axis=1)
+                bins = prob.argmax(axis=1)
+                max_prob = prob[np.arange(len(prob)), bins]
+                entropy = -(prob * np.log(np.clip(prob, 1e-12, None))).sum(axis=1)
+                for name, b, p, h in zip(contignames[contig_start:contig_start + len(prob)], bins, max_prob, entropy):
+                    bins_file.write(f"{name}\t{b}\t{p:.4f}\t{h:.4f}\n")
+                contig_start += len(prob)
+        latent_file.flush()
+        del latent_file
+        if pooled_file is not None:
+            pooled_file.flush()
+            del pooled_file
+        if prob_file is not None:
+            prob_file.flush()
+            del prob_file
+        if bins_file is not None:
+            bins_file.close()
 
         # fit_gmm(latent_feature, contignames, os.path.join(self.result_path, 'gmm.csv'), self.num_classes)
         # get_binning_result(self.contig_path, os.path.join(self.result_path, 'gmm.csv'), os.path.join(self.result_path, 'pre_bins'))
+        return result_path
+
+    def pooled_latent_path(self):
+        return "{}/latent_pooled.npy".format(self.result_path)
+
+    def prob_cat_path(self):
+        return "{}/prob_cat.npy".format(self.result_path)
+
+    def categorical_bins_path(self):
+        return "{}/categorical_bins.tsv".format(self.result_path)
 
     def rec_best_gmm(self):
         get_binning_result(self.contig_path, os.path.join(self.result_path, 'gmm.csv'), os.path.join(self.result_path, 'pre_bins'))
@@ -1,3 +1,4 @@
+import copy
 import math
 import torch
 import torch.nn.init as init
@@ -67,11 +68,68 @@ class Gaussian(nn.Module):
 
   def forward(self, x):
     mu = self.mu(x)
-    var = F.softplus(self.var(x))
+    # keep the variance in float32 under autocast, softplus underflows in bf16
+    var = F.softplus(self.var(x).float())
     z = self.reparameterize(mu, var)
     return mu, var, z
 
 
+def fold_batchnorm(linear, bn=None):
+  """Folds an eval-mode BatchNorm1d into the Linear layer consuming its output.
+
+  With bn(x) = a * x + c, linear(bn(x)) = (W * a) x + (W c + b), so the pair
+  collapses into a single Linear layer for inference.
+
+  Args:
+      linear (nn.Linear): layer applied right after the batch norm.
+      bn (nn.BatchNorm1d): batch norm to fold, None returns a detached copy.
+
+  Returns:
+      folded (nn.Linear): standalone layer with frozen parameters.
+  """
+  folded = copy.deepcopy(linear)
+  with torch.no_grad():
+    if bn is not None:
+      scale = torch.rsqrt(bn.running_var + bn.eps)
+      shift = -bn.running_mean * scale
+      if bn.affine:
+        scale = scale * bn.weight
+        shift = shift * bn.weight + bn.bias
+      folded.bias.copy_(linear.bias + linear.weight @ shift)
+      folded.weight.copy_(linear.weight * scale)
+  folded.requires_grad_(False)
+  return folded
+
+
+def fold_layers(layers, head):
+  """Folds every BatchNorm1d of an inference stack into the next Linear layer.
+
+  Dropout is dropped (identity in eval mode), activations are kept as is.
+
+  Args:
+      layers (iterable): Linear / ReLU / BatchNorm1d / Dropout stack.
+      head (nn.Linear): output layer following the stack.
+
+  Returns:
+      body (nn.Sequential): folded stack.
+      head (nn.Linear): folded output layer.
+  """
+  folded = []
+  pending_bn = None
+  for layer in list(layers) + [head]:
+    if isinstance(layer, nn.BatchNorm1d):
+      pending_bn = layer
+    elif isinstance(layer, nn.Dropout):
+      continue
+    elif isinstance(layer, nn.Linear):
+      folded.append(fold_batchnorm(layer, pending_bn))
+      pending_bn = None
+    else:
+      folded.append(layer)
+  head = folded.pop()
+  return nn.Sequential(*folded), head
+
+
 class GraphAttentionBlock(nn.Module):
     def __init__(
         self,
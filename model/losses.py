@@ -70,6 +70,8 @@ class LossFunctions:
          output: (array/float) depending on average parameters the result will be the mean
                                 of all the sample losses or an array with the losses per sample
       """
+      # evaluated in float32 even when the forward pass runs under bf16 autocast
+      x, mu, var = x.float(), mu.float(), var.float()
       if self.eps > 0.0:
         var = var + self.eps
       return -0.5 * torch.sum(
@@ -107,7 +109,8 @@ class LossFunctions:
           output: (array/float) depending on average parameters the result will be the mean
                                 of all the sample losses or an array with the losses per sample
       """
-      log_q = F.log_softmax(logits, dim=-1)
+      log_q = F.log_softmax(logits.float(), dim=-1)
+      targets = targets.float()
       return -torch.mean(torch.sum(targets * log_q, dim=-1))
 
 
@@ -3,7 +3,7 @@ import zarr
 import torch
 import scipy.sparse as sp
 from scipy.linalg import fractional_matrix_power
-from sklearn.neighbors import NearestNeighbors
+from utils.knn import cached_knn
 import networkx as nx
 import numpy as np
 from tqdm import tqdm, trange
@@ -162,11 +162,11 @@ class Pipeline(Dataset):
             id_list.append(data_list[i]["id"])
         
         feature_array = np.array(feature_list, dtype="float32")
-        nbrs = NearestNeighbors(n_neighbors=k+1, algorithm='auto',  metric='euclidean', n_jobs=50).fit(feature_array)
-        distances, indices = nbrs.kneighbors(feature_array)
+        # exact tiled search for small/medium datasets, HNSW above; distances are squared l2
+        indices, distances = cached_knn(feature_array, k + 1, num_threads=min(50, os.cpu_count()))
         for i in trange(feature_array.shape[0], desc="Creating KNN graph..."):
             neighbors_array = indices[i][1:]
-            distance_array = np.power(distances[i][1:], 2)
+            distance_array = distances[i][1:]
             invalid_idx = np.where(distance_array >= threshold)
             distance_array = np.delete(distance_array, invalid_idx)
             neighbors_array = np.delete(neighbors_array, invalid_idx)
@@ -37,6 +37,7 @@ from utils import (
 )
 
 from utils.calculate_bin_num import gen_cannot_link as cal_num_bins
+from utils.quality import MARKER_TABLE, write_marker_table
 
 # link 145 filter_threshold line 286 inputos.add_argument('-m', dest='minlength', metavar='', type=int, default=2500,
 
@@ -209,14 +210,17 @@ def create_contigs_zarr_dataset(
     root.attrs["num_bins"] = num_bins
 
 def run(outdir, fastapath, bampaths, rpkmpath, jgipath,
-        mincontiglength, norefcheck, minalignscore, minid, subprocesses, output_zarr_path, logfile):
+        mincontiglength, norefcheck, minalignscore, minid, subprocesses, output_zarr_path, logfile, orf_cache=None):
 
     log('Date and time is ' + str(datetime.datetime.now()), logfile, 1)
     begintime = time.time()
 
-    num_bins = cal_num_bins(fastapath, mincontiglength, 20, output=outdir + '/tmp_hmmsearch')
+    num_bins = cal_num_bins(fastapath, mincontiglength, 20, output=outdir + '/tmp_hmmsearch', orf_cache=orf_cache)
     # Get TNFs, save as npz
     tnfs, contignames, contiglengths = calc_tnf(outdir, fastapath, mincontiglength, logfile)
+    # Marker hits of the whole assembly, subset per bin during secondary clustering
+    write_marker_table(os.path.join(outdir, 'tmp_hmmsearch', 'markers.hmmout'),
+                       os.path.join(outdir, MARKER_TABLE), contignames)
 
     # Parse BAMs, save as npz
     refhash = None if norefcheck else vambtools._hash_refnames(
@@ -294,6 +298,8 @@ def main():
                                '[min(' + str(DEFAULT_PROCESSES) + ', nbamfiles)]'))
     inputos.add_argument('--norefcheck', help='skip reference name hashing check [False]',
                          action='store_true')
+    inputos.add_argument('--orf_cache', metavar='', default=None,
+                         help='ORF cache database shared between runs, only new contigs are sent to prodigal [None]')
     inputos.add_argument('--minfasta', dest='minfasta', metavar='', type=int, default=None,
                          help='minimum bin size to output as fasta [None = no files]')
 
@@ -338,7 +344,8 @@ def main():
             subprocesses=subprocesses,
             output_zarr_path=output_zarr_path,
             # label_path=args.label_path,
-            logfile=logfile)
+            logfile=logfile,
+            orf_cache=args.orf_cache)
 
 
 if __name__ == '__main__':
@@ -9,16 +9,24 @@ import random
 import shutil
 import multiprocessing
 import traceback
+import collections
+import queue
+import time
 from multiprocessing.pool import Pool
 from utils.bh_kmeans import bh_kmeans
+from utils.calculate_bin_num import run_prodigal, run_fraggenescan, run_hmmsearch, run_orffinder_cached
 import numpy as np
 import glob
 from collections import defaultdict
 import argparse
 from utils.utils import get_binning_result
-from utils.leiden import leiden_clustering_scanpy, cluster
+from utils.leiden import leiden_clustering_scanpy, leiden_cluster, cluster_hierarchy
+from utils.latent_export import load_latent
+from utils.shared_arrays import SharedArrays, attach_shared_arrays, shared_array
+from utils.quality import MarkerScorer, select_partition, load_marker_table, subset_marker_table
+from utils.quality import estimate_bin_quality, write_quality_report
+from utils.constraints import as_pairs, bin_constraints, drop_conflicts
 import pandas as pd
-import anndata as ad
 
 def fasta_iter(fname, full_header=False):
     '''Iterate over a (possibly gzipped) FASTA file
@@ -95,8 +103,24 @@ normalize_marker_trans__dict = {
     'TIGR02386': 'TIGR02387',
 }
 
-def get_marker(hmmout, fasta_path=None, min_contig_len=None, multi_mode=False, orf_finder = None, bin_num_mode='median'):
-    import pandas as pd
+def cannot_link_pairs(gene_codes, contig_codes):
+    '''Contig pairs sharing a single-copy marker gene, by a grouped self-join on integer codes
+    Parameters
+    gene_codes: int array (marker gene of every hit)
+    contig_codes: int array (contig of every hit)
+    Returns deduplicated (m, 2) int64 array of (smaller, larger) contig codes
+    '''
+    hits = pd.DataFrame({'gene': np.asarray(gene_codes), 'contig': np.asarray(contig_codes)}).drop_duplicates()
+    pairs = hits.merge(hits, on='gene')
+    pairs = pairs[pairs['contig_x'] < pairs['contig_y']]
+    if not len(pairs):
+        return np.empty((0, 2), dtype=np.int64)
+    return np.unique(pairs[['contig_x', 'contig_y']].to_numpy(dtype=np.int64), axis=0)
+
+def get_marker(hmmout, fasta_path=None, min_contig_len=None, multi_mode=False, orf_finder = None, bin_num_mode='median', contignames=None):
+    '''Cannot-link pairs are returned as a (m, 2) int array of indices into contignames
+    (default: the contigs of fasta_path in file order); hits on other contigs are ignored.
+    '''
     data = pd.read_table(hmmout, sep=r'\s+',  comment='#', header=None,
                          usecols=(0,3,5,15,16), names=['orf', 'gene', 'qlen', 'qstart', 'qend'])
     if not len(data):
@@ -117,11 +141,11 @@ def get_marker(hmmout, fasta_path=None, min_contig_len=None, multi_mode=False, o
         contig_len = {h:len(seq) for h,seq in fasta_iter(fasta_path)}
         data = data[data['contig'].map(lambda c: contig_len[c] >= min_contig_len)]
     data = data.drop_duplicates(['gene', 'contig'])
-    cannot_link = []
-    for indices in data.groupby('gene').indices.values():
-        for i in range(len(indices)):
-            for j in range(i+1, len(indices)):
-                cannot_link.append((data.iloc[indices[i]]['contig'], data.iloc[indices[j]]['contig']))
+    if contignames is None:
+        contignames = [h for h, _ in fasta_iter(fasta_path)] if fasta_path is not None else sorted(data['contig'].unique())
+    contig_codes = pd.Index(contignames).get_indexer(data['contig'])
+    found = contig_codes >= 0
+    cannot_link = cannot_link_pairs(pd.factorize(data['gene'])[0][found], contig_codes[found])
 
     def extract_seeds(vs, sel, bin_num_mode):
         vs = vs.sort_values()
@@ -148,99 +172,17 @@ def get_marker(hmmout, fasta_path=None, min_contig_len=None, multi_mode=False, o
         return res
     else:
         counts = data.groupby('gene')['orf'].count()
-        return extract_seeds(counts, data, bin_num_mode), list(set(cannot_link))
-
-def prodigal(contig_file, contig_output):
-        with open(contig_output + '.out', 'w') as prodigal_out_log:
-            subprocess.check_call(
-                ['prodigal',
-                 '-i', contig_file,
-                 '-p', 'meta',
-                 '-q',
-                 '-m', # See https://github.com/BigDataBiology/SemiBin/issues/87
-                 '-a', contig_output
-                 ],
-                stdout=prodigal_out_log,
-            )
-
-def run_prodigal(fasta_path, num_process, output):
-
-    contigs = {}
-    for h, seq in fasta_iter(fasta_path):
-        contigs[h] = seq
-
-    total_len = sum(len(s) for s in contigs.values())
-    split_len = total_len // num_process
-
-    cur = split_len + 1
-    next_ix = 0
-    out = None
-    with contextlib.ExitStack() as stack:
-        for h,seq in contigs.items():
-            if cur > split_len and next_ix < num_process:
-                if out is not None:
-                    out.close()
-                out = open(os.path.join(output, 'contig_{}.fa'.format(next_ix)), 'wt')
-                out = stack.enter_context(out)
-
-                cur = 0
-                next_ix += 1
-            out.write(f'>{h}\n{seq}\n')
-            cur += len(seq)
-
-    with LoggingPool(num_process) if num_process != 0 else LoggingPool() as pool:
-        try:
-            for index in range(next_ix):
-                pool.apply_async(
-                    prodigal,
-                    args=(
-                        os.path.join(output, 'contig_{}.fa'.format(index)),
-                        os.path.join(output, 'contig_{}.faa'.format(index)),
-                    ))
-            pool.close()
-            pool.join()
-        except:
-            sys.stderr.write(
-                f"Error: Running prodigal fail\n")
-            sys.exit(1)
+        return extract_seeds(counts, data, bin_num_mode), cannot_link
 
-    contig_output = os.path.join(output, 'contigs.faa')
-    with open(contig_output, 'w') as f:
-        for index in range(next_ix):
-            f.write(open(os.path.join(output, 'contig_{}.faa'.format(index)), 'r').read())
-    return contig_output
-
-def run_fraggenescan(fasta_path, num_process, output):
-    try:
-        contig_output = os.path.join(output, 'contigs.faa')
-        with open(contig_output + '.out', 'w') as frag_out_log:
-            # We need to call FragGeneScan instead of the Perl wrapper because the
-            # Perl wrapper does not handle filepaths correctly if they contain spaces
-            # This binary does not handle return codes correctly, though, so we
-            # cannot use `check_call`:
-            subprocess.call(
-                [shutil.which('FragGeneScan'),
-                 '-s', fasta_path,
-                 '-o', contig_output,
-                 '-w', str(0),
-                 '-t', 'complete',
-                 '-p', str(num_process),
-                 ],
-                stdout=frag_out_log,
-            )
-    except:
-        sys.stderr.write(
-            f"Error: Running fraggenescan failed\n")
-        sys.exit(1)
-    return contig_output + '.faa'
-
-def gen_cannot_link(fasta_path, binned_length, num_process, bin_num_mode, multi_mode=False, output = None, orf_finder = 'prodigal'):
+def gen_cannot_link(fasta_path, binned_length, num_process, bin_num_mode, multi_mode=False, output = None, orf_finder = 'prodigal', contignames=None, orf_cache=None):
     '''Estimate number of bins from a FASTA file
     Parameters
     fasta_path: path
     binned_length: int (minimal contig length)
     num_process: int (number of CPUs to use)
     multi_mode: bool, optional (if True, treat input as resulting from concatenating multiple files)
+    contignames: list, optional (order the cannot-link indices refer to, default: FASTA order)
+    orf_cache: path, optional (ORF cache database, only new or changed contigs are sent to the ORF finder)
     '''
     with tempfile.TemporaryDirectory() as tdir:
         if output is not None:
@@ -253,24 +195,15 @@ def gen_cannot_link(fasta_path, binned_length, num_process, bin_num_mode, multi_
         else:
             target_dir = tdir
 
-        run_orffinder = run_prodigal if orf_finder == 'prodigal' else run_fraggenescan
-        contig_output = run_orffinder(fasta_path, num_process, tdir)
+        if orf_cache is not None:
+            contig_output = run_orffinder_cached(fasta_path, num_process, tdir, orf_finder, orf_cache)
+        else:
+            run_orffinder = run_prodigal if orf_finder == 'prodigal' else run_fraggenescan
+            contig_output = run_orffinder(fasta_path, num_process, tdir)
 
         hmm_output = os.path.join(target_dir, 'markers.hmmout')
         try:
-            with open(os.path.join(tdir, 'markers.hmmout.out'), 'w') as hmm_out_log:
-                subprocess.check_call(
-                    ['hmmsearch',
-                     '--domtblout',
-                     hmm_output,
-                     '--cut_tc',
-                     '--cpu', str(num_process),
-                     os.path.split(__file__)[0] + '/utils/marker.hmm',
-                    #  './utils/marker.hmm',
-                     contig_output,
-                     ],
-                    stdout=hmm_out_log,
-                )
+            run_hmmsearch(contig_output, hmm_output, num_process, tdir)
         except:
             if os.path.exists(hmm_output):
                 os.remove(hmm_output)
@@ -278,32 +211,41 @@ def gen_cannot_link(fasta_path, binned_length, num_process, bin_num_mode, multi_
                 f"Error: Running hmmsearch fail\n")
             sys.exit(1)
 
-        marker = get_marker(hmm_output, fasta_path, binned_length, multi_mode, orf_finder=orf_finder, bin_num_mode=bin_num_mode)
+        marker = get_marker(hmm_output, fasta_path, binned_length, multi_mode, orf_finder=orf_finder, bin_num_mode=bin_num_mode, contignames=contignames)
 
         return marker
 
+def gen_cannot_link_from_table(marker_table, target_contig, bin_num_mode):
+    '''Estimate number of bins and cannot-link pairs of one bin from the genome-wide marker table
+    Same results as gen_cannot_link on the bin FASTA, without running prodigal / hmmsearch again
+    Parameters
+    marker_table: pd.DataFrame (see utils.quality.write_marker_table)
+    target_contig: list (contig names of the bin)
+    bin_num_mode: str (max or median)
+    Returns (number of bins, (m, 2) int array of cannot-link indices into target_contig)
+    '''
+    data = subset_marker_table(marker_table, target_contig).drop_duplicates(['gene', 'row'])
+    if not len(data):
+        return 0, np.empty((0, 2), dtype=np.int64)
+    cannot_link = cannot_link_pairs(pd.factorize(data['gene'])[0], data['row'].to_numpy())
+
+    counts = data.groupby('gene')['row'].count().sort_values()
+    if bin_num_mode == 'median':
+        seed_count = counts.iloc[len(counts) // 2]
+    elif bin_num_mode == 'max':
+        seed_count = counts.iloc[len(counts) - 1]
+    # ties broken by the shortest query, as in get_marker
+    qlen = data.drop_duplicates('gene').set_index('gene')['qlen']
+    gene = qlen.loc[counts.index[counts == seed_count]].idxmin()
+    return int(counts[gene]), cannot_link
+
 def gen_cannot_link_indices(dataset, cl, ml, contignames, target_contig):
-    target_indices = dict()
-    cl_indices = list()
-    ml_indices = list()
-    for contig in target_contig:
-        target_indices[contig] = int(np.where(contignames == contig)[0][0])
-        
-    bin_data = dataset[list(target_indices.values())]
-    target_contig = contignames[list(target_indices.values())]
-
-    target_indices = dict()
-    for contig in target_contig:
-        target_indices[str(contig)] = int(np.where(target_contig == contig)[0][0])
-
-    for ml1, ml2 in ml:
-        if ml1 in target_indices.keys() and ml2 in target_indices.keys():
-            ml_indices.append((target_indices[ml1], target_indices[ml2]))
-
-    for cl1, cl2 in cl:
-        cl_indices.append((target_indices[cl1], target_indices[cl2]))
-    return cl_indices, ml_indices, bin_data, target_contig
-    
+    '''cl: (m, 2) int array of indices into target_contig, as returned by gen_cannot_link(contignames=target_contig)
+    Returns cl and ml as (m, 2) int arrays of indices into bin_data, see utils.constraints.bin_constraints
+    '''
+    rows, ml_indices, cl_indices = bin_constraints(contignames, target_contig, ml, cl)
+    return cl_indices, ml_indices, dataset[rows], contignames[rows]
+
 
 def read_bins(file):
     bins = defaultdict(list)
@@ -325,7 +267,10 @@ def read_must_link(file, contignames):
             must_link.append((contig_dict[items[0]], contig_dict[items[1]]))
     return must_link
 
-def merge_bins(bin_dict, issu_bins, post_bin_list):
+def merge_bins(bin_dict, issue_bins, post_bin_list):
+    '''Replace the refined bins by their sub-bins and renumber
+    The result only depends on the order of bin_dict and post_bin_list, not on the order the refinements finished in
+    '''
     for bin_num in issue_bins:
         bin_dict.pop(bin_num)
     for post_bins in post_bin_list:
@@ -334,7 +279,88 @@ def merge_bins(bin_dict, issu_bins, post_bin_list):
     merge_bin_dict = dict(zip(range(len(bin_dict)), bin_dict.values()))
     return merge_bin_dict
 
-def get_issue_bins(checkm_path):
+def _refine_task(cluster_num, rows, n_clusters, ml, cl, p, random_state, time_limit):
+    '''Split one bin with bh_kmeans on the latent rows attached from shared memory'''
+    bin_data = shared_array('latent')[rows]
+    labels = bh_kmeans(bin_data, n_clusters, ml=ml, cl=cl, p=p, random_state=random_state,
+                       time_limit=time_limit, solver='greedy')
+    return cluster_num, np.asarray(labels)
+
+def refine_bins(latent, contignames, bin_dict, issue_bins, must_link, marker_table, bin_num_mode='max',
+                num_workers=16, timeout=600, p=3, random_state=2021):
+    '''Split contaminated bins concurrently and merge the sub-bins
+    Parameters
+    latent: np.ndarray (one row per contig in contignames)
+    bin_dict: dict (bin number -> contig names)
+    issue_bins: list (bin numbers to split)
+    must_link: list ((name, name) pairs)
+    marker_table: pd.DataFrame (see utils.quality.write_marker_table)
+    num_workers: int (maximum number of worker processes)
+    timeout: float (seconds per bin; bh_kmeans returns its best labels at the limit, and a bin still running
+        after twice the limit is kept as it is)
+    Returns the merged bin_dict, see merge_bins
+    '''
+    tasks = []
+    for cluster_num in sorted(issue_bins):
+        if cluster_num not in bin_dict:
+            continue
+        n_clusters, cannot_link = gen_cannot_link_from_table(marker_table, bin_dict[cluster_num], bin_num_mode)
+        rows, ml_indices, cl_indices = bin_constraints(contignames, bin_dict[cluster_num], must_link, cannot_link)
+        if len(rows) < 2:
+            continue
+        ml_indices, cl_indices = purify_must_link(ml_indices, cl_indices)
+        n_clusters = min(max(n_clusters, 2), len(rows))
+        tasks.append((cluster_num, rows, n_clusters, ml_indices, cl_indices, p, random_state, timeout))
+
+    if not tasks:
+        return merge_bins(bin_dict, [], [])
+
+    # the latent goes to shared memory once, tasks only carry row indices and constraints
+    pending_tasks = collections.deque(tasks)
+    finished = queue.Queue()
+    num_processes = max(1, min(num_workers, len(tasks)))
+    deadlines, results = {}, {}
+    stuck = 0
+    with SharedArrays({'latent': latent}) as shared, \
+            Pool(num_processes, initializer=attach_shared_arrays, initargs=(shared.specs,)) as pool:
+        while pending_tasks or deadlines:
+            # submit lazily, so a task starts running when it is submitted and its deadline is meaningful
+            while pending_tasks and len(deadlines) + stuck < num_processes:
+                task = pending_tasks.popleft()
+                pool.apply_async(_refine_task, task, callback=finished.put,
+                                 error_callback=lambda e, c=task[0]: finished.put((c, e)))
+                deadlines[task[0]] = time.time() + 2 * timeout
+            if not deadlines:
+                print(f'no free worker left, bins {[task[0] for task in pending_tasks]} are not refined')
+                break
+            try:
+                cluster_num, labels = finished.get(timeout=max(0, min(deadlines.values()) - time.time()))
+            except queue.Empty:
+                for cluster_num in [c for c, deadline in deadlines.items() if deadline <= time.time()]:
+                    print(f'bin {cluster_num} timed out, kept as it is')
+                    deadlines.pop(cluster_num)
+                    # the worker cannot be interrupted and stays busy until the pool terminates
+                    stuck += 1
+                continue
+            if deadlines.pop(cluster_num, None) is None:
+                continue
+            if isinstance(labels, Exception):
+                print(f'bin {cluster_num} failed, kept as it is: {labels!r}')
+                continue
+            results[cluster_num] = labels
+
+    # merge in bin order, whatever order the workers finished in
+    post_bin_list = []
+    for cluster_num, rows, *_ in tasks:
+        if cluster_num not in results:
+            continue
+        post_bin = {}
+        for l in np.unique(results[cluster_num]):
+            post_bin[str(cluster_num) + '_' + str(l)] = [str(contig) for contig in contignames[rows[results[cluster_num] == l]]]
+        post_bin_list.append(post_bin)
+    return merge_bins(bin_dict, sorted(results), post_bin_list)
+
+def read_checkm(checkm_path):
     keys = ['Bin Id', 'Marker lineage',	'# genomes', '# markers', '# marker sets',
                 '0', '1', '2', '3',	'4', '5+', 'Completeness', 'Contamination',	'Strain heterogeneity']
     # checkm_results = ['vamb_1000.tsv']
@@ -347,26 +373,26 @@ def get_issue_bins(checkm_path):
             if len(elems) == 15:
                 elems.pop(2)
                 checkm_result.append(dict(zip(keys, elems)))
+    return checkm_result
 
+def select_issue_bins(records):
+    '''Bins with > 90% completeness and >= 5% contamination, from CheckM or utils.quality.estimate_bin_quality records'''
     # calculate the num of bins in different level, for precision
     issue_bins = []
-    for record in checkm_result:
+    for record in records:
         if float(record['Completeness']) > 90 and float(record['Contamination']) >= 5:
             issue_bins.append(int(record['Bin Id'].split('.')[1]))
     return issue_bins
 
+def get_issue_bins(checkm_path):
+    return select_issue_bins(read_checkm(checkm_path))
+
 def purify_must_link(ml_indices, cl_indices):
-    delete_indices = []
-    if len(ml_indices) != 0:
-        for idx, (ml1, ml2) in enumerate(ml_indices):
-            if ((ml1, ml2) in cl_indices) or ((ml2, ml1) in cl_indices):
-                delete_indices.append(idx)
-
-        for i in sorted(delete_indices, reverse=True):
-            del ml_indices[i]
+    ml_indices, delete_indices = drop_conflicts(ml_indices, cl_indices)
+    if len(ml_indices) + len(delete_indices) != 0:
         print('del_idx', end='')
-        print(delete_indices)
-    return ml_indices, cl_indices
+        print(delete_indices.tolist())
+    return ml_indices, as_pairs(cl_indices)
 
             
 if __name__ == "__main__":
@@ -379,8 +405,25 @@ if __name__ == "__main__":
     # parser.add_argument('--must_link_path', type=str, default='/datahome/datasets/ericteam/csmxrao/DeepMetaBin/tmp/hlj10x/must_link.csv', help='Output path for all splitted samples')
     # parser.add_argument('--latent_path', type=str, default='/datahome/datasets/ericteam/csmxrao/DeepMetaBin/tmp/hlj10x/latents/latent_80_21141_best.npy', help='Output path for all splitted samples')
     # parser.add_argument('--checkm_path', type=str, default='/datahome/datasets/ericteam/csmxrao/DeepMetaBin/tmp/hlj10x/gmm_bins/checkm.tsv', help='Output path for all splitted samples')
+    parser.add_argument('--latent_path', type=str, default=None, help='Latent to cluster: full, compact or view-pooled (train.py --pool_views) export (default: <primary_out>/results/latent.npy)')
+    parser.add_argument('--n_views', type=int, default=6, help='Number of consecutive rows (views) per contig in contignames and the full latent')
     parser.add_argument('--binned_length', type=int, default=1000, help='ignore contig length under this threshold')
     parser.add_argument('--mode', type=str, default='max', help='Scg bin number mode (max or median)')
+    parser.add_argument('--engine', type=str, default=None, choices=['leiden', 'hierarchy', 'scanpy'], help='Clustering engine (default: hierarchy when --n_bins or --hmmout is given, leiden otherwise)')
+    parser.add_argument('--resolution', type=float, default=None, help='Leiden resolution, or resolution at which the hierarchy is cut (leiden default: 1.0)')
+    parser.add_argument('--n_bins', type=int, default=None, help='Cut the persisted Leiden hierarchy into this number of bins')
+    parser.add_argument('--max_edges', type=int, default=100, help='Neighbors per contig in the Leiden graph')
+    parser.add_argument('--partgraph_ratio', type=int, default=100, help='Percentile of the kNN distances kept as Leiden graph edges')
+    parser.add_argument('--threads', type=int, default=os.cpu_count(), help='Number of threads for the kNN search')
+    parser.add_argument('--hmmout', type=str, default=None, help='markers.hmmout of the contigs, selects the hierarchy resolution by marker quality')
+    parser.add_argument('--marker_table', type=str, default=None, help='markers.tsv written by preprocessing, gives the per-bin markers for refinement')
+    parser.add_argument('--refine', action='store_true', help='Split contaminated bins with bh_kmeans and marker cannot-links (needs --marker_table)')
+    parser.add_argument('--checkm_path', type=str, default=None, help='checkm.tsv of the secondary bins, gives the bins to refine (default: estimated from --marker_table)')
+    parser.add_argument('--must_link_path', type=str, default=None, help='must_link.csv used as must-link constraints during refinement')
+    parser.add_argument('--workers', type=int, default=min(16, os.cpu_count()), help='Number of bins refined concurrently')
+    parser.add_argument('--bin_timeout', type=float, default=600, help='Time limit in seconds for the refinement of one bin')
+    parser.add_argument('--single_fasta', action='store_true', help='Write one indexed bins.fasta instead of a FASTA file per bin')
+    parser.add_argument('--patience', type=int, default=3, help='Resolutions without marker quality improvement before the selection stops')
 
 
     args = parser.parse_args()
@@ -398,56 +441,82 @@ if __name__ == "__main__":
 
     # fasta_bin = glob.glob(os.path.join(args.primary_out, 'results', 'pre_bins', 'cluster.*.fasta'))
     contignames = np.load(args.contigname_path)['arr_0']
-    latent = np.load(os.path.join(args.primary_out, 'results', 'latent.npy'))
-
-    indices_to_save = np.arange(0, len(contignames), 6)
-
-    contignames = contignames[indices_to_save]
-    latent = latent[indices_to_save]
+    latent_path = args.latent_path or os.path.join(args.primary_out, 'results', 'latent.npy')
+    latent = load_latent(latent_path, mmap_mode='r')
+
+    # one row per contig: view 0 names, and the pooled latent as is or every n_views-th row of the full one
+    contignames = contignames[::args.n_views]
+    if len(latent) != len(contignames):
+        latent = latent[::args.n_views]
+    if len(latent) != len(contignames):
+        raise ValueError(f'{latent_path} matches neither {len(contignames)} contigs nor {len(contignames)} x {args.n_views} views')
     # bin_dict = read_bins(os.path.join(args.primary_out, 'results', 'gmm.csv'))
     # must_link = read_must_link(os.path.join(args.primary_out, 'must_link.csv'), contignames)
     # issue_bins = get_issue_bins(os.path.join(args.primary_out, 'results', 'pre_bins', 'checkm.tsv'))
 
+    # marker_table = load_marker_table(args.marker_table)
     # issue_bins = [0, 11, 17, 23, 25, 26, 29, 39, 6, 9, 31,18, 30, 12]
     # post_bin_list = []
 
 
-    # use scanpy.leiden
-    anndata = ad.AnnData(X=latent)
-    anndata.obs_names = contignames
-    leiden_clustered= leiden_clustering_scanpy(anndata)
-    labels = leiden_clustered.obs['leiden'].values
+    engine = args.engine or ('hierarchy' if args.n_bins is not None or args.hmmout is not None else 'leiden')
+    cache_dir = os.path.dirname(os.path.abspath(latent_path))
+    if engine == 'hierarchy':
+        # cut the hierarchy, built once and persisted next to the latent
+        hierarchy = cluster_hierarchy(latent, contignames, threads=args.threads, max_edges=args.max_edges,
+                                      partgraph_ratio=args.partgraph_ratio, cache_dir=cache_dir)
+        if args.hmmout is not None:
+            # walk from fine to coarse cuts and keep the best marker quality
+            scorer = MarkerScorer.from_hmmout(args.hmmout, contignames)
+            resolutions = np.geomspace(hierarchy.base_resolution, hierarchy.base_resolution * 1e-4, 41)
+            candidates = ((r, hierarchy.cut(resolution=r)) for r in resolutions)
+            resolution, labels, history = select_partition(candidates, scorer, patience=args.patience)
+            print(f'selected resolution {resolution} after {len(history)} cuts: {scorer.summary(labels)}')
+        else:
+            labels = hierarchy.cut(resolution=args.resolution, n_bins=args.n_bins)
+    elif engine == 'leiden':
+        # cached kNN -> vectorised graph -> leidenalg RBER with contig length node sizes
+        labels = leiden_cluster(latent, contignames, threads=args.threads, max_edges=args.max_edges,
+                                partgraph_ratio=args.partgraph_ratio,
+                                resolution_parameter=1.0 if args.resolution is None else args.resolution,
+                                cache_dir=cache_dir)
+    else:
+        # use scanpy.leiden
+        import anndata as ad
+        anndata = ad.AnnData(X=np.asarray(latent))
+        anndata.obs_names = contignames
+        leiden_clustered= leiden_clustering_scanpy(anndata)
+        labels = leiden_clustered.obs['leiden'].values
     
     # use leidenalg
     # labels = cluster(latent, threads = 120, contignames = contignames, max_edges=100)
 
-    # for bin_path in fasta_bin:
-    #     cluster_num = int(os.path.basename(bin_path).replace('cluster.','').replace('.fasta', ''))
-    #     if cluster_num in issue_bins:
-    #         n_clusters, cannot_link = gen_cannot_link(bin_path, args.binned_length, 20, bin_num_mode=args.mode, output=args.output_path)
-    #         cl_indices, ml_indices, bin_data, target_contig = gen_cannot_link_indices(latent, cannot_link, must_link, contignames, bin_dict[cluster_num])
-    #         ml_indices, cl_indices = purify_must_link(ml_indices, cl_indices)
-    #         if n_clusters <= 1:
-    #             n_clusters = 2
-    #         labels = bh_kmeans(bin_data, n_clusters, ml=ml_indices, cl=cl_indices, p=3, random_state=2021, time_limit=600)
-    #         post_bin = defaultdict(list)
-    #         for l, contigname in zip(labels, target_contig):
-    #             post_bin[str(cluster_num) + '_' + str(l)].append(str(contigname))
-    #         post_bin_list.append(dict(post_bin))
-  
-
-    # bin_dict = merge_bins(bin_dict, issue_bins, post_bin_list)
-    # with open(os.path.join(args.output_path, f'post_cluster.csv'), 'w') as f:
-    #     for key, val in bin_dict.items():
-    #         for v in val:
-    #             f.write(f'{str(v)}\t{str(key)}\n')
+    bin_dict = defaultdict(list)
+    for key, val in zip(labels, contignames):
+        bin_dict[int(key)].append(str(val))
+    bin_dict = dict(sorted(bin_dict.items()))
+    if args.refine:
+        # split contaminated bins with marker cannot-links, bins run concurrently on the shared latent
+        marker_table = load_marker_table(args.marker_table)
+        if args.checkm_path is not None:
+            issue_bins = get_issue_bins(args.checkm_path)
+        else:
+            # in-process marker estimate instead of a CheckM run over the bins
+            records = estimate_bin_quality(marker_table, bin_dict)
+            write_quality_report(records, os.path.join(args.output_path, 'bin_quality.tsv'))
+            issue_bins = select_issue_bins(records)
+        print(f'refining {len(issue_bins)} bins: {issue_bins}')
+        must_link = read_must_link(args.must_link_path, contignames) if args.must_link_path is not None else []
+        bin_dict = refine_bins(latent, contignames, bin_dict, issue_bins, must_link, marker_table,
+                               bin_num_mode=args.mode, num_workers=args.workers, timeout=args.bin_timeout)
 
     with open(os.path.join(args.output_path, f'post_cluster.csv'), 'w') as f:
-        for key, val in zip(labels, contignames):
-            f.write(f'{str(val)}\t{str(key)}\n')
+        for key, val in bin_dict.items():
+            for v in val:
+                f.write(f'{str(v)}\t{str(key)}\n')
 
-    get_binning_result('/datahome/datasets/ericteam/csgyguo/DeepMetaBin/deepmetabin_out/aug0/sequences_combined.fasta', os.path.join(args.output_path, f'post_cluster.csv'), os.path.join(args.output_path, 'secondary_bins'))
-    # get_binning_result(args.contig_path, os.path.join(args.output_path, f'post_cluster.csv'), os.path.join(args.output_path, 'secondary_bins'))
+    get_binning_result(args.contig_path, os.path.join(args.output_path, f'post_cluster.csv'), os.path.join(args.output_path, 'secondary_bins'),
+                       single_file=args.single_fasta)
     
     
 
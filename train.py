@@ -1,5 +1,6 @@
 import os
 import os.path as osp
+import time
 import torch
 import torch.nn as nn
 from torch.utils.data import DataLoader
@@ -13,7 +14,9 @@ from pathlib import Path
 
 from utils.cov import coverage_score as cov
 
-from utils.utils import seed_everything, Wandb_logger, _optimizer, coverage_score
+from utils.utils import seed_everything, Wandb_logger, _optimizer, coverage_score, autocast_context, precision_parity, fit_gmm
+from utils.latent_export import export_compact_latent
+from utils.gmm import ViewMean
 from model.pipeline import Pipeline
 from model.graph_gmvae import DeepMetaBinModel
 import shutil
@@ -44,10 +47,21 @@ def main():
     parser.add_argument("--contig_path", type=str, default='./sample_data/contigs.fasta', help="Contig fasta path")
     parser.add_argument("--exp_name", "-exp", type=str, default='time', help="Name for this experiment")
     parser.add_argument("--batch_size", "-b", type=int, default=420, help="Batch size for NN")
+    parser.add_argument("--inference_batch_size", type=int, default=60000, help="Chunk size when writing latents after training")
+    parser.add_argument("--n_views", type=int, default=6, help="Number of consecutive rows (augmented views) per contig in the dataset")
+    parser.add_argument("--pool_views", type=str, default='none', choices=['none', 'mean', 'first'], help="Also write results/latent_pooled.npy with one row per contig: mean of its views or view 0 (default: not written)")
+    parser.add_argument("--categorical_bins", action='store_true', help="Write results/categorical_bins.tsv: per-contig bin, probability and entropy from the view-averaged categorical head")
+    parser.add_argument("--gmm", type=str, default='none', choices=['none', 'diag', 'tied'], help="Fit a streaming-EM GMM (per-bin or shared diagonal covariance) on the contig latents, write results/gmm.csv and pre_bins")
+    parser.add_argument("--gmm_init", type=str, default='prob_cat', choices=['prob_cat', 'kmeans++'], help="GMM initialisation: the view-averaged categorical head or k-means++ with the estimated number of bins")
+    parser.add_argument("--gmm_threads", type=int, default=os.cpu_count(), help="Threads of the GMM fit")
+    parser.add_argument("--latent_dtype", type=str, default='float32', choices=['float32', 'float16'], help="Storage dtype of the compact latent export")
+    parser.add_argument("--latent_dim", type=int, default=0, help="PCA dimension of the compact latent export (0 keeps all dimensions)")
     parser.add_argument("--num_workers", type=int, default=50, help="Number of workers")
     parser.add_argument("--output", type=str, default="./deepmetabin_out", help="Output for deepmetabin")
     parser.add_argument("--num_epoch", "-e", type=int, default=500, help="Epoch for NN")
     parser.add_argument("--multisample", type=bool, default=False, help="Multi-sample or single-sample")
+    parser.add_argument("--precision", type=str, default='fp32', choices=['fp32', 'bf16'], help="Precision of forward and loss computation (bf16 uses CPU autocast)")
+    parser.add_argument("--compile", type=str, default='none', choices=['none', 'compile', 'torchscript'], help="Compiled GMVAENet execution (torch.compile falls back to TorchScript on older torch)")
     args = parser.parse_args()
 
     ######Initialization######
@@ -81,7 +95,7 @@ def main():
                     )
     val_loader = DataLoader(
                     dataset=pip,
-                    batch_size=len(pip),
+                    batch_size=min(args.inference_batch_size, len(pip)),
                     num_workers=args.num_workers,
                     pin_memory=False,
                     shuffle=False,
@@ -101,6 +115,9 @@ def main():
                              result_path=osp.join(args.output, 'results'),
                              contig_path=args.contig_path
                              )
+    if args.compile != 'none':
+        compiled = model.enable_compiled_execution(args.compile)
+        logging.info(f"Compiled GMVAENet with backend: {compiled.backend}")
     scheduler, optimizer = _optimizer(model=model, 
                         lr=args.learning_rate, 
                         weight_decay=args.weight_decay, 
@@ -115,15 +132,25 @@ def main():
     for epoch in range(args.num_epoch):
         logging.info(f"Epoch ({epoch}/{args.num_epoch})")
         model.train()
+        epoch_start = time.perf_counter()
+        num_samples = 0
         for i, batch in enumerate(tqdm(dataloader, ncols=80, desc='Training')):
             optimizer.zero_grad()
-            lossdict = model.training_step(batch, i)['loss']
-            loss = lossdict["total"]
+            with autocast_context(args.precision):
+                lossdict = model.training_step(batch, i)['loss']
+                loss = lossdict["total"]
             # logging.logging_with_step('loss', loss, epoch * len(dataloader) + i)
             loss.backward()
             optimizer.step()
+            num_samples += len(batch["feature"])
             # logging.info(f'loss: {lossdict["total"]}, cat_loss: {lossdict["categorical"]}, gauss_loss: {lossdict["gaussian"]}, rec_loss: {lossdict["reconstruction"]}, cl_loss: {lossdict["contrastive"]}')
+        epoch_time = time.perf_counter() - epoch_start
         logging.info(f'loss: {lossdict["total"]}, cat_loss: {lossdict["categorical"]}, gauss_loss: {lossdict["gaussian"]}, rec_loss: {lossdict["reconstruction"]}, cl_loss: {lossdict["contrastive"]}')
+        logging.info(f'[{args.precision}/{args.compile}] epoch time: {epoch_time:.2f}s, throughput: {num_samples / epoch_time:.1f} samples/s')
+        if args.precision != 'fp32':
+            fp32_loss, low_loss = precision_parity(model, batch, args.precision)
+            logging.info(f'loss parity on last batch: fp32 {fp32_loss:.6f}, {args.precision} {low_loss:.6f}, '
+                         f'relative diff {abs(low_loss - fp32_loss) / max(abs(fp32_loss), 1e-12):.2e}')
 
         scheduler.step()
         if loss <= best_loss:
@@ -141,11 +168,40 @@ def main():
         
     model.eval()
     with torch.no_grad():
-        for batch in val_loader:
-            model.validation_step(batch)
+        latent_path = model.save_latent(val_loader, n_views=args.n_views, pool_views=args.pool_views,
+                                        save_prob=args.gmm != 'none' and args.gmm_init == 'prob_cat',
+                                        categorical_bins=args.categorical_bins)
 
     # logging.info("Wrote contigs into bins")
-    logging.info("Latent saved")
+    logging.info(f"Latent saved to {latent_path}")
+    if args.pool_views != 'none':
+        logging.info(f"View-pooled ({args.pool_views}) latent saved to {model.pooled_latent_path()}")
+    if args.latent_dtype != 'float32' or args.latent_dim > 0:
+        compact_path = export_compact_latent(latent_path,
+                                             osp.join(args.output, 'results', 'latent_compact.npy'),
+                                             dtype=args.latent_dtype,
+                                             n_components=args.latent_dim or None,
+                                             projection_path=osp.join(args.output, 'results', 'latent_projection.npz'),
+                                             chunk_size=args.inference_batch_size)
+        logging.info(f"Compact latent saved to {compact_path}")
+    if args.categorical_bins:
+        logging.info(f"Categorical head bins saved to {model.categorical_bins_path()}")
+    if args.gmm != 'none':
+        # one row per contig: the pooled latent, or view 0 of the full one
+        contignames = np.load(args.contignames_path)['arr_0'][::args.n_views]
+        latent = np.load(model.pooled_latent_path() if args.pool_views != 'none' else latent_path, mmap_mode='r')
+        if len(latent) != len(contignames):
+            latent = latent[::args.n_views]
+        init_resp, num_bins = None, zarr.open(args.zarr_dataset_path, mode='r').attrs['num_bins']
+        if args.gmm_init == 'prob_cat':
+            # views are averaged chunk by chunk during the fit, prob_cat stays on disk
+            init_resp = ViewMean(np.load(model.prob_cat_path(), mmap_mode='r'), args.n_views)
+            num_bins = init_resp.shape[1]
+        gmm_path = osp.join(args.output, 'results', 'gmm.csv')
+        fit_gmm(latent, contignames, gmm_path, num_bins, covariance_type=args.gmm, init_resp=init_resp,
+                num_threads=args.gmm_threads, chunk_size=args.inference_batch_size)
+        logging.info(f"GMM ({args.gmm}, {num_bins} components) bins saved to {gmm_path}")
+        model.rec_best_gmm()
     logging.info('Finish training!')
 
     # Training include early stopping(deactivated)
@@ -1,6 +1,7 @@
 from scipy.spatial.distance import cdist
+from scipy.sparse.csgraph import connected_components
 from sklearn.cluster import kmeans_plusplus
-import gurobipy as gb
+import scipy.sparse as sp
 import numpy as np
 import time
 
@@ -15,8 +16,12 @@ def update_centers(X, centers, n_clusters, labels):
     Returns:
         np.array: the updated positions of cluster centers
     """
-    for i in range(n_clusters):
-        centers[i] = X[labels == i, :].mean(axis=0)
+    # one sparse (k, n) indicator product instead of a boolean mask per cluster
+    indicator = sp.csr_matrix((np.ones(len(labels)), (labels, np.arange(len(labels)))), shape=(n_clusters, len(labels)))
+    counts = np.asarray(indicator.sum(axis=1)).ravel()
+    sums = np.asarray(indicator @ X)
+    filled = counts > 0
+    centers[filled] = sums[filled] / counts[filled, None]
     return centers
 
 
@@ -33,6 +38,8 @@ def assign_objects(X, centers, ml, cl, p, assignment_time_limit):
         np.array: cluster labels for objects
     """
 
+    import gurobipy as gb
+
     # Compute model input
     n = X.shape[0]
     k = centers.shape[0]
@@ -66,6 +73,105 @@ def assign_objects(X, centers, ml, cl, p, assignment_time_limit):
     return labels
 
 
+class PairConstraints:
+    """Must-link / cannot-link pairs prepared once for the greedy solver.
+
+    Must-link pairs are contracted into groups (connected components), which
+    are assigned as a whole; cannot-link pairs become a sparse adjacency
+    between groups. Cannot-link pairs inside a group cannot be satisfied
+    together with the must-links and are left as they are.
+
+    Args:
+        n (int): number of objects.
+        ml (list or np.array): must-link pairs, (m, 2).
+        cl (list or np.array): cannot-link pairs, (c, 2).
+    """
+    def __init__(self, n, ml, cl):
+        ml = np.asarray(ml, dtype=np.int64).reshape(-1, 2)
+        cl = np.asarray(cl, dtype=np.int64).reshape(-1, 2)
+        ml_graph = sp.coo_matrix((np.ones(len(ml)), (ml[:, 0], ml[:, 1])), shape=(n, n))
+        self.n_groups, self.group = connected_components(ml_graph, directed=False)
+        # (n_groups, n) indicator, sums object distances into group costs
+        self.members = sp.csr_matrix((np.ones(n), (self.group, np.arange(n))), shape=(self.n_groups, n))
+        a, b = self.group[cl[:, 0]], self.group[cl[:, 1]]
+        keep = a != b
+        a, b = a[keep], b[keep]
+        cannot = sp.coo_matrix((np.ones(2 * len(a)), (np.concatenate((a, b)), np.concatenate((b, a)))),
+                               shape=(self.n_groups, self.n_groups)).tocsr()
+        cannot.sum_duplicates()
+        self.cannot = cannot
+
+
+def assign_objects_greedy(X, centers, constraints, p):
+    """Assigns objects to clusters by penalised greedy assignment, without a MIP solver.
+
+    Minimises the same objective as assign_objects: distance to the assigned
+    center plus max_distance * p per violated cannot-link pair, must-links being
+    enforced by assigning must-link groups as a whole. Groups start at their
+    cheapest cluster; groups with cannot-link neighbors are then moved one at a
+    time to their cheapest cluster given the current neighbor labels until no
+    move improves, and empty clusters finally take the group that is cheapest to
+    move there.
+
+    Args:
+        X (np.array): feature vectors of objects
+        centers (np.array): current positions of cluster centers
+        constraints (PairConstraints): prepared must-link / cannot-link pairs
+        p (float): control parameter for penalty
+    Returns:
+        np.array: cluster labels for objects
+    """
+    k = centers.shape[0]
+    distances = cdist(X, centers)
+    penalty = distances.max() * p
+    cost = np.asarray(constraints.members @ distances)
+    group_labels = cost.argmin(axis=1)
+
+    cannot = constraints.cannot
+    if cannot.nnz:
+        # conflicts[g, j]: cannot-link neighbors of group g currently in cluster j
+        onehot = sp.csr_matrix((np.ones(len(group_labels)), (np.arange(len(group_labels)), group_labels)),
+                               shape=(len(group_labels), k))
+        conflicts = np.asarray((cannot @ onehot).todense())
+        active = np.flatnonzero(np.diff(cannot.indptr) > 0)
+        for _ in range(100):
+            moved = False
+            for g in active:
+                best = int(np.argmin(cost[g] + penalty * conflicts[g]))
+                old = group_labels[g]
+                if best != old:
+                    neighbors = cannot.indices[cannot.indptr[g]:cannot.indptr[g + 1]]
+                    weights = cannot.data[cannot.indptr[g]:cannot.indptr[g + 1]]
+                    conflicts[neighbors, old] -= weights
+                    conflicts[neighbors, best] += weights
+                    group_labels[g] = best
+                    moved = True
+            if not moved:
+                break
+    else:
+        conflicts = np.zeros((len(group_labels), k))
+
+    # every cluster must receive at least one group, as in the MIP
+    group_sizes = np.bincount(group_labels, minlength=k)
+    for j in np.flatnonzero(group_sizes == 0):
+        own = np.arange(len(group_labels))
+        delta = cost[:, j] + penalty * conflicts[:, j] - cost[own, group_labels] - penalty * conflicts[own, group_labels]
+        delta[group_sizes[group_labels] <= 1] = np.inf
+        g = int(np.argmin(delta))
+        if not np.isfinite(delta[g]):
+            break
+        group_sizes[group_labels[g]] -= 1
+        group_sizes[j] += 1
+        if cannot.nnz:
+            neighbors = cannot.indices[cannot.indptr[g]:cannot.indptr[g + 1]]
+            weights = cannot.data[cannot.indptr[g]:cannot.indptr[g + 1]]
+            conflicts[neighbors, group_labels[g]] -= weights
+            conflicts[neighbors, j] += weights
+        group_labels[g] = j
+
+    return group_labels[constraints.group]
+
+
 def get_total_distance(X, centers, labels):
     """Computes total distance between objects and cluster centers
     Args:
@@ -80,7 +186,7 @@ def get_total_distance(X, centers, labels):
 
 
 def bh_kmeans(X, n_clusters, ml=None, cl=None, p=1, random_state=None, max_iter=100, time_limit=None,
-              assignment_time_limit=None):
+              assignment_time_limit=None, solver='greedy'):
     """Finds partition of X subject to must-link and cannot-link constraints
     Args:
         X (np.array): feature vectors of objects
@@ -92,6 +198,8 @@ def bh_kmeans(X, n_clusters, ml=None, cl=None, p=1, random_state=None, max_iter=
         max_iter (int): maximum number of iterations of bh_kmeans algorithm
         time_limit (int): algorithm time limit
         assignment_time_limit (int): solver time limit
+        solver (str): 'greedy' for the license-free penalised assignment, 'gurobi'
+            for the MIP (needs gurobipy and a license)
     Returns:
         np.array: cluster labels of objects
     """
@@ -110,6 +218,16 @@ def bh_kmeans(X, n_clusters, ml=None, cl=None, p=1, random_state=None, max_iter=
     if cl is None:
         cl = []
 
+    if solver == 'greedy':
+        constraints = PairConstraints(X.shape[0], ml, cl)
+        assign = lambda centers: assign_objects_greedy(X, centers, constraints, p)
+    elif solver == 'gurobi':
+        ml = [tuple(pair) for pair in np.asarray(ml, dtype=np.int64).reshape(-1, 2).tolist()]
+        cl = [tuple(pair) for pair in np.asarray(cl, dtype=np.int64).reshape(-1, 2).tolist()]
+        assign = lambda centers: assign_objects(X, centers, ml, cl, p, assignment_time_limit)
+    else:
+        raise ValueError(f"Unknown solver: {solver}")
+
     # Start stopwatch
     tic = time.perf_counter()
 
@@ -117,7 +235,7 @@ def bh_kmeans(X, n_clusters, ml=None, cl=None, p=1, random_state=None, max_iter=
     centers, _ = kmeans_plusplus(X, n_clusters=n_clusters, random_state=random_state)
 
     # Assign objects
-    labels = assign_objects(X, centers, ml, cl, p, assignment_time_limit)
+    labels = assign(centers)
 
     # Initialize best labels
     best_labels = labels
@@ -133,7 +251,7 @@ def bh_kmeans(X, n_clusters, ml=None, cl=None, p=1, random_state=None, max_iter=
     while (n_iter < max_iter) and (elapsed_time < time_limit):
 
         # Assign objects
-        labels = assign_objects(X, centers, ml, cl, p, assignment_time_limit)
+        labels = assign(centers)
 
         # Update centers
         centers = update_centers(X, centers, n_clusters, labels)
@@ -0,0 +1,130 @@
+import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from utils.quality import strip_view_suffix
+
+
+def read_bin_map(cluster_result):
+    """Reads a '<contig> <bin>' (whitespace or comma separated) binning file.
+
+    Returns:
+        bin_map (dict): bin -> contig names, bins in order of first appearance.
+    """
+    bin_map = defaultdict(list)
+    with open(cluster_result, 'r') as f:
+        for line in f:
+            items = line.strip().split(',') if ',' in line else line.split()
+            if len(items) < 2:
+                continue
+            bin_map[items[1]].append(items[0])
+    return dict(bin_map)
+
+
+def _bin_lookup(bin_map):
+    """Assembly contig name -> bins it belongs to.
+
+    Names are also registered without their view suffix, so bins of view
+    names (..._aug_k_newid_i) pick up their contig from the assembly.
+    """
+    lookup = defaultdict(list)
+    for bin_name, names in bin_map.items():
+        for name in names:
+            lookup[name].append(bin_name)
+    for name in list(lookup):
+        contig = strip_view_suffix(name)
+        if contig not in lookup:
+            lookup[contig] = lookup[name]
+    return lookup
+
+
+def _fasta_records(contig_path):
+    """Streams (header, sequence) of a FASTA file, header cut at the first whitespace."""
+    header, chunks = None, []
+    with open(contig_path, 'r') as f:
+        for line in f:
+            if line.startswith('>'):
+                if header is not None:
+                    yield header, ''.join(chunks)
+                header, chunks = line[1:].split()[0], []
+            else:
+                chunks.append(line.strip())
+    if header is not None:
+        yield header, ''.join(chunks)
+
+
+def _append(path, chunks):
+    with open(path, 'a') as f:
+        f.writelines(chunks)
+
+
+def write_bins(contig_path, bin_map, output, num_workers=8, buffer_bytes=1 << 26, single_file=False):
+    """Writes bin FASTA files in one streaming pass over the assembly.
+
+    Every record is routed to its bins through a name lookup and buffered per
+    bin. Once the buffers hold more than buffer_bytes, the largest are handed
+    to writer threads, so memory stays bounded whatever the assembly size.
+    The appends of one bin always go to the same thread and keep their order.
+    Old '.fasta' outputs in the directory are removed first.
+
+    Args:
+        contig_path (string): assembly FASTA.
+        bin_map (dict): bin -> contig names, see read_bin_map.
+        output (string): output directory.
+        num_workers (int): number of writer threads.
+        buffer_bytes (int): maximal number of buffered bytes.
+        single_file (bool): write one 'bins.fasta' (headers '<contig> cluster.<bin>')
+            and its samtools faidx index instead of one 'cluster.<bin>.fasta' per bin.
+
+    Returns:
+        missing (list): contig names of bin_map that are not in the assembly.
+    """
+    os.makedirs(output, exist_ok=True)
+    for file in os.listdir(output):
+        if ".fasta" in file:
+            os.remove(os.path.join(output, file))
+
+    lookup = _bin_lookup(bin_map)
+    found = set()
+    if single_file:
+        fasta_path = os.path.join(output, 'bins.fasta')
+        offset = 0
+        with open(fasta_path, 'w') as out, open(fasta_path + '.fai', 'w') as index:
+            for header, seq in _fasta_records(contig_path):
+                for bin_name in lookup.get(header, ()):
+                    record_header = f'>{header} cluster.{bin_name}\n'
+                    out.write(record_header + seq + '\n')
+                    index.write(f'{header}\t{len(seq)}\t{offset + len(record_header)}\t{len(seq)}\t{len(seq) + 1}\n')
+                    offset += len(record_header) + len(seq) + 1
+                    found.add(header)
+    else:
+        paths = {bin_name: os.path.join(output, f'cluster.{bin_name}.fasta') for bin_name in bin_map}
+        for path in paths.values():
+            open(path, 'w').close()
+        slots = {bin_name: i % num_workers for i, bin_name in enumerate(bin_map)}
+        executors = [ThreadPoolExecutor(1) for _ in range(num_workers)]
+        buffers, sizes, pending, total = defaultdict(list), defaultdict(int), [], 0
+        try:
+            for header, seq in _fasta_records(contig_path):
+                for bin_name in lookup.get(header, ()):
+                    buffers[bin_name].append(f'>{header}\n{seq}\n')
+                    sizes[bin_name] += len(seq) + len(header) + 3
+                    total += len(seq) + len(header) + 3
+                    found.add(header)
+                while total > buffer_bytes:
+                    bin_name = max(sizes, key=sizes.get)
+                    pending.append(executors[slots[bin_name]].submit(_append, paths[bin_name], buffers.pop(bin_name)))
+                    total -= sizes.pop(bin_name)
+                # bound the memory held by queued writes as well
+                if len(pending) > 4 * num_workers:
+                    for future in pending:
+                        future.result()
+                    pending = []
+            for bin_name in list(buffers):
+                pending.append(executors[slots[bin_name]].submit(_append, paths[bin_name], buffers.pop(bin_name)))
+            for future in pending:
+                future.result()
+        finally:
+            for executor in executors:
+                executor.shutdown()
+    return [name for names in bin_map.values() for name in names
+            if name not in found and strip_view_suffix(name) not in found]
@@ -9,7 +9,10 @@ import random
 import shutil
 import multiprocessing
 import traceback
+import heapq
+import time
 from multiprocessing.pool import Pool
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import glob
 from collections import defaultdict
@@ -143,6 +146,7 @@ def get_marker(hmmout, fasta_path=None, min_contig_len=None, multi_mode=False, o
         return extract_seeds(counts, data)
 
 def prodigal(contig_file, contig_output):
+        tic = time.perf_counter()
         with open(contig_output + '.out', 'w') as prodigal_out_log:
             subprocess.check_call(
                 ['prodigal',
@@ -154,52 +158,60 @@ def prodigal(contig_file, contig_output):
                  ],
                 stdout=prodigal_out_log,
             )
+        return time.perf_counter() - tic
 
-def run_prodigal(fasta_path, num_process, output):
-
-    contigs = {}
-    for h, seq in fasta_iter(fasta_path):
-        contigs[h] = seq
+def balanced_shards(lengths, num_shards):
+    '''Longest-processing-time assignment of contigs to shards
+    Contigs are taken from longest to shortest and each goes to the shard with the least bases so far,
+    so shards stay balanced even when the FASTA is sorted by length
+    Returns (shard of every contig, bases per shard)
+    '''
+    lengths = np.asarray(lengths, dtype=np.int64)
+    num_shards = min(num_shards, len(lengths))
+    shard = np.empty(len(lengths), dtype=np.int64)
+    loads = [(0, i) for i in range(num_shards)]
+    for ix in np.argsort(-lengths, kind='stable'):
+        load, i = heapq.heappop(loads)
+        shard[ix] = i
+        heapq.heappush(loads, (load + int(lengths[ix]), i))
+    return shard, np.bincount(shard, weights=lengths, minlength=num_shards).astype(np.int64)
 
-    total_len = sum(len(s) for s in contigs.values())
-    split_len = total_len // num_process
+def run_prodigal(fasta_path, num_process, output):
 
-    cur = split_len + 1
-    next_ix = 0
-    out = None
+    # lengths first, then stream every contig into its shard, so sequences are never all held in memory
+    lengths = [len(seq) for _, seq in fasta_iter(fasta_path)]
+    num_shards = num_process if num_process != 0 else os.cpu_count()
+    shard, shard_len = balanced_shards(lengths, num_shards)
+    next_ix = len(shard_len)
     with contextlib.ExitStack() as stack:
-        for h,seq in contigs.items():
-            if cur > split_len and next_ix < num_process:
-                if out is not None:
-                    out.close()
-                out = open(os.path.join(output, 'contig_{}.fa'.format(next_ix)), 'wt')
-                out = stack.enter_context(out)
-
-                cur = 0
-                next_ix += 1
-            out.write(f'>{h}\n{seq}\n')
-            cur += len(seq)
+        outs = [stack.enter_context(open(os.path.join(output, 'contig_{}.fa'.format(index)), 'wt'))
+                for index in range(next_ix)]
+        for ix, (h, seq) in enumerate(fasta_iter(fasta_path)):
+            outs[shard[ix]].write(f'>{h}\n{seq}\n')
 
     with LoggingPool(num_process) if num_process != 0 else LoggingPool() as pool:
         try:
-            for index in range(next_ix):
-                pool.apply_async(
+            results = [pool.apply_async(
                     prodigal,
                     args=(
                         os.path.join(output, 'contig_{}.fa'.format(index)),
                         os.path.join(output, 'contig_{}.faa'.format(index)),
-                    ))
+                    )) for index in range(next_ix)]
             pool.close()
             pool.join()
+            elapsed = [result.get() for result in results]
         except:
             sys.stderr.write(
                 f"Error: Running prodigal fail\n")
             sys.exit(1)
+    for index in range(next_ix):
+        print(f'prodigal shard {index}: {shard_len[index]} bp in {elapsed[index]:.1f}s')
 
     contig_output = os.path.join(output, 'contigs.faa')
     with open(contig_output, 'w') as f:
         for index in range(next_ix):
-            f.write(open(os.path.join(output, 'contig_{}.faa'.format(index)), 'r').read())
+            with open(os.path.join(output, 'contig_{}.faa'.format(index)), 'r') as shard_faa:
+                shutil.copyfileobj(shard_faa, f)
     return contig_output
 
 def run_fraggenescan(fasta_path, num_process, output):
@@ -226,13 +238,121 @@ def run_fraggenescan(fasta_path, num_process, output):
         sys.exit(1)
     return contig_output + '.faa'
 
-def gen_cannot_link(fasta_path, binned_length, num_process, multi_mode=False, output = None, orf_finder = 'prodigal'):
+def run_orffinder_cached(fasta_path, num_process, output, orf_finder, cache_path):
+    '''Predict ORFs only for contigs whose sequence is not in the cache (see utils.orf_cache.OrfCache)
+    New proteins are added to the cache, and cached and new proteins are written to contigs.faa in FASTA order
+    Parameters
+    fasta_path: path
+    num_process: int (number of CPUs to use)
+    output: path (working directory)
+    orf_finder: str (prodigal or fraggenescan)
+    cache_path: path (sqlite database)
+    '''
+    from utils.orf_cache import OrfCache, sequence_key
+    run_orffinder = run_prodigal if orf_finder == 'prodigal' else run_fraggenescan
+    splits = 1 if orf_finder == 'prodigal' else 3
+    with OrfCache(cache_path) as cache:
+        keys = [(h, sequence_key(seq, orf_finder)) for h, seq in fasta_iter(fasta_path)]
+        known = cache.known(k for _, k in keys)
+        missing = {h: k for h, k in keys if k not in known}
+        print(f'ORF cache: {len(keys) - len(missing)} of {len(keys)} contigs cached')
+        if missing:
+            new_dir = os.path.join(output, 'uncached')
+            os.makedirs(new_dir, exist_ok=True)
+            new_fasta = os.path.join(new_dir, 'contigs.fa')
+            with open(new_fasta, 'w') as f:
+                for h, seq in fasta_iter(fasta_path):
+                    if h in missing:
+                        f.write(f'>{h}\n{seq}\n')
+            proteins = defaultdict(list)
+            with open(run_orffinder(new_fasta, num_process, new_dir)) as f:
+                for line in f:
+                    if line.startswith('>'):
+                        contig = line[1:].split()[0].rsplit('_', splits)[0]
+                    proteins[contig].append(line)
+            # contigs without ORFs are cached too, as empty records
+            cache.put_many((k, cache.strip_name(''.join(proteins.get(h, [])), h)) for h, k in missing.items())
+
+        contig_output = os.path.join(output, 'contigs.faa')
+        with open(contig_output, 'w') as f:
+            for start in range(0, len(keys), 10000):
+                batch = keys[start:start + 10000]
+                records = cache.get_many(k for _, k in batch)
+                for h, k in batch:
+                    f.write(cache.restore_name(records[k], h))
+    return contig_output
+
+MARKER_HMM = os.path.join(os.path.split(os.path.abspath(__file__))[0], 'marker.hmm')
+
+def split_fasta(fasta_path, n_shards, output, prefix='shard'):
+    '''Split a FASTA file into n_shards files, record by record in turn, streaming
+    Returns the paths of the non-empty shards
+    '''
+    paths = [os.path.join(output, f'{prefix}_{i}.faa') for i in range(n_shards)]
+    counts = [0] * n_shards
+    with contextlib.ExitStack() as stack:
+        outs = [stack.enter_context(open(path, 'w')) for path in paths]
+        ix = -1
+        with open(fasta_path) as f:
+            for line in f:
+                if line.startswith('>'):
+                    ix = (ix + 1) % n_shards
+                    counts[ix] += 1
+                outs[ix].write(line)
+    return [path for path, count in zip(paths, counts) if count]
+
+def hmmsearch(faa_path, domtblout, threads, hmm_path=MARKER_HMM):
+    with open(domtblout + '.out', 'w') as hmm_out_log:
+        subprocess.check_call(
+            ['hmmsearch',
+             '--domtblout', domtblout,
+             '--cut_tc',
+             '--cpu', str(threads),
+             hmm_path,
+             faa_path,
+             ],
+            stdout=hmm_out_log,
+        )
+    return domtblout
+
+def run_hmmsearch(faa_path, hmm_output, num_process, output, threads_per_search=4, hmm_path=MARKER_HMM):
+    '''Search the marker HMMs with one hmmsearch process per protein shard and merge the domtblouts
+    hmmsearch threading stops scaling past a few cores, so num_process // threads_per_search
+    searches run side by side. With --cut_tc hits are selected by the model bit score cutoffs,
+    which do not depend on the database size, so the merged table has the same hits as one search.
+    Parameters
+    faa_path: path (proteins, e.g. contigs.faa)
+    hmm_output: path (merged domtblout)
+    num_process: int (number of CPUs to use)
+    output: path (directory for the shards)
+    '''
+    n_shards = max(1, num_process // threads_per_search)
+    threads = max(1, num_process // n_shards)
+    shards = split_fasta(faa_path, n_shards, output, prefix='hmm_shard') if n_shards > 1 else [faa_path]
+    with ThreadPoolExecutor(len(shards)) as executor:
+        futures = [executor.submit(hmmsearch, shard, shard + '.hmmout', threads, hmm_path) for shard in shards]
+        shard_outputs = [future.result() for future in futures]
+    # stream the shard tables into one, keeping only the leading comment header of the first
+    header = True
+    with open(hmm_output, 'w') as out:
+        for shard_output in shard_outputs:
+            with open(shard_output) as f:
+                for line in f:
+                    if not line.startswith('#'):
+                        header = False
+                        out.write(line)
+                    elif header:
+                        out.write(line)
+    return hmm_output
+
+def gen_cannot_link(fasta_path, binned_length, num_process, multi_mode=False, output = None, orf_finder = 'prodigal', orf_cache=None):
     '''Estimate number of bins from a FASTA file
     Parameters
     fasta_path: path
     binned_length: int (minimal contig length)
     num_process: int (number of CPUs to use)
     multi_mode: bool, optional (if True, treat input as resulting from concatenating multiple files)
+    orf_cache: path, optional (ORF cache database, only new or changed contigs are sent to the ORF finder)
     '''
     with tempfile.TemporaryDirectory() as tdir:
         if output is not None:
@@ -244,25 +364,15 @@ def gen_cannot_link(fasta_path, binned_length, num_process, multi_mode=False, ou
         else:
             target_dir = tdir
 
-        run_orffinder = run_prodigal if orf_finder == 'prodigal' else run_fraggenescan
-        contig_output = run_orffinder(fasta_path, num_process, tdir)
+        if orf_cache is not None:
+            contig_output = run_orffinder_cached(fasta_path, num_process, tdir, orf_finder, orf_cache)
+        else:
+            run_orffinder = run_prodigal if orf_finder == 'prodigal' else run_fraggenescan
+            contig_output = run_orffinder(fasta_path, num_process, tdir)
 
         hmm_output = os.path.join(target_dir, 'markers.hmmout')
         try:
-            with open(os.path.join(tdir, 'markers.hmmout.out'), 'w') as hmm_out_log:
-                subprocess.check_call(
-                    ['hmmsearch',
-                     '--domtblout',
-                     hmm_output,
-                     '--cut_tc',
-                     '--cpu', str(num_process),
-                     os.path.split(__file__)[0] + '/marker.hmm',
-                    #  './src/utils/marker.hmm',
-
-                     contig_output,
-                     ],
-                    stdout=hmm_out_log,
-                )
+            run_hmmsearch(contig_output, hmm_output, num_process, tdir)
         except:
             if os.path.exists(hmm_output):
                 os.remove(hmm_output)
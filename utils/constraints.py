@@ -0,0 +1,92 @@
+import numpy as np
+import pandas as pd
+
+
+def as_pairs(pairs):
+    """Returns constraint pairs as an (m, 2) int64 array (empty input gives (0, 2))."""
+    return np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+
+
+def index_of(names, queries):
+    """Position of every query name in names, through a single hash lookup.
+
+    Args:
+        names (array-like): reference names, e.g. contignames, (N,).
+        queries (array-like): names to look up, (M,).
+
+    Returns:
+        indices (np.ndarray): int64 index of the first occurrence of every
+            query in names, -1 for names that are missing, (M,).
+    """
+    names = pd.Index(np.asarray(names).astype(str))
+    queries = np.asarray(queries).astype(str)
+    if names.is_unique:
+        return names.get_indexer(queries).astype(np.int64)
+    first = ~names.duplicated()
+    indices = names[first].get_indexer(queries)
+    return np.where(indices >= 0, np.flatnonzero(first)[indices], -1).astype(np.int64)
+
+
+def map_pairs(pairs, names):
+    """Maps (name, name) constraint pairs onto indices into names.
+
+    Pairs with a name that is not in names are dropped.
+
+    Args:
+        pairs (list): (name, name) tuples or an (m, 2) array of names.
+        names (array-like): names the returned indices refer to.
+
+    Returns:
+        pairs (np.ndarray): (k, 2) int64 array, in input order.
+    """
+    pairs = np.asarray(pairs, dtype=object).reshape(-1, 2)
+    indices = index_of(names, pairs.ravel()).reshape(-1, 2)
+    return indices[(indices >= 0).all(axis=1)]
+
+
+def pair_keys(pairs, n):
+    """Undirected int64 key of every pair, equal for (a, b) and (b, a)."""
+    pairs = as_pairs(pairs)
+    return pairs.min(axis=1) * n + pairs.max(axis=1)
+
+
+def drop_conflicts(ml, cl):
+    """Removes must-link pairs that are also cannot-linked, in either direction.
+
+    Args:
+        ml (array-like): must-link index pairs, (m, 2).
+        cl (array-like): cannot-link index pairs, (c, 2).
+
+    Returns:
+        ml (np.ndarray): kept must-link pairs, (k, 2).
+        dropped (np.ndarray): positions of the removed pairs in the input ml.
+    """
+    ml, cl = as_pairs(ml), as_pairs(cl)
+    if not len(ml) or not len(cl):
+        return ml, np.empty(0, dtype=np.int64)
+    n = int(max(ml.max(), cl.max())) + 1
+    conflict = np.isin(pair_keys(ml, n), pair_keys(cl, n))
+    return ml[~conflict], np.flatnonzero(conflict)
+
+
+def bin_constraints(contignames, target_contig, ml, cl):
+    """Prepares the constraints of one bin for bh_kmeans.
+
+    Args:
+        contignames (np.ndarray): names of the latent rows, (N,).
+        target_contig (list): contig names of the bin.
+        ml (list): must-link (name, name) pairs over the whole assembly.
+        cl (array-like): cannot-link pairs as indices into target_contig.
+
+    Returns:
+        rows (np.ndarray): latent rows of the bin, in target_contig order.
+        ml (np.ndarray): must-link pairs inside the bin, as indices into rows.
+        cl (np.ndarray): cannot-link pairs, as indices into rows.
+
+    Raises:
+        KeyError: when a contig of the bin is not in contignames.
+    """
+    rows = index_of(contignames, target_contig)
+    if (rows < 0).any():
+        raise KeyError(f"contigs not in contignames: {list(np.asarray(target_contig)[rows < 0][:5])}")
+    return rows, map_pairs(ml, np.asarray(contignames)[rows]), as_pairs(cl)
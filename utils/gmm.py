@@ -0,0 +1,180 @@
+import math
+import numpy as np
+import torch
+from sklearn.cluster import kmeans_plusplus
+
+
+class ViewMean:
+    """Lazy mean over the consecutive view rows of every contig.
+
+    Wraps an (N * n_views, K) array, e.g. a memory-mapped prob_cat.npy, as
+    (N, K) without loading it: a row slice only reads and averages the views
+    of those contigs, so StreamingGMM can take it as init_resp chunk by chunk.
+
+    Args:
+        array (np.ndarray): view rows, contig-major, dimension is (N * n_views, K).
+        n_views (int): number of consecutive rows per contig.
+    """
+    def __init__(self, array, n_views):
+        if len(array) % n_views:
+            raise ValueError(f"{len(array)} rows are not a multiple of {n_views} views")
+        self.array = array
+        self.n_views = n_views
+        self.shape = (len(array) // n_views,) + tuple(array.shape[1:])
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, rows):
+        if not isinstance(rows, slice) or rows.step not in (None, 1):
+            raise TypeError("ViewMean only supports contiguous row slices")
+        start, stop, _ = rows.indices(len(self))
+        views = np.asarray(self.array[start * self.n_views:stop * self.n_views], dtype=np.float32)
+        return views.reshape(-1, self.n_views, *self.shape[1:]).mean(axis=1)
+
+
+class StreamingGMM:
+    """Gaussian mixture with diagonal covariances, fitted by streaming EM.
+
+    Every EM iteration reads the data chunk by chunk and only accumulates the
+    per-component sufficient statistics (mass, sums and sums of squares), so
+    memory is O(chunk_size * K + K * D) whatever N is, and memory-mapped
+    latents stay on disk. The E-step of a chunk is three matrix products,
+    O(N * K * D) per iteration instead of the O(N * K * D^2) of full
+    covariances, and runs on as many threads as torch is given.
+
+    Args:
+        n_components (int): number of components.
+        covariance_type (string): 'diag', one diagonal covariance per
+            component, or 'tied', one diagonal covariance shared by all.
+        max_iter (int): maximal number of EM iterations.
+        tol (float): stops once the mean log-likelihood gains less than tol.
+        reg_covar (float): added to the variances for numerical stability.
+        chunk_size (int): number of rows per chunk.
+        random_state (int): seed of the k-means++ initialisation.
+        device (string): torch device of the computation.
+    """
+    def __init__(self, n_components, covariance_type='diag', max_iter=100, tol=1e-3, reg_covar=1e-6,
+                 chunk_size=65536, random_state=2021, device='cpu'):
+        if covariance_type not in ('diag', 'tied'):
+            raise ValueError(f"Unknown covariance_type: {covariance_type}")
+        self.n_components = n_components
+        self.covariance_type = covariance_type
+        self.max_iter = max_iter
+        self.tol = tol
+        self.reg_covar = reg_covar
+        self.chunk_size = chunk_size
+        self.random_state = random_state
+        self.device = device
+        self.n_iter_ = 0
+
+    def _chunks(self, X):
+        for start in range(0, len(X), self.chunk_size):
+            # a writable copy, memory-mapped chunks are read-only
+            chunk = np.array(X[start:start + self.chunk_size], dtype=np.float32)
+            yield start, torch.from_numpy(chunk).to(self.device)
+
+    def _estimate_weighted_log_prob(self, x):
+        """log(weight_k) + log N(x | mean_k, var_k) of every row, (B, K)."""
+        precision = 1.0 / self.variances_
+        mahalanobis = ((x * x) @ precision.T
+                       - 2.0 * x @ (self.means_ * precision).T
+                       + (self.means_ * self.means_ * precision).sum(dim=1))
+        log_det = torch.log(self.variances_).sum(dim=1)
+        return -0.5 * (x.shape[1] * math.log(2 * math.pi) + log_det + mahalanobis) + torch.log(self.weights_)
+
+    def _m_step(self, mass, sums, squares):
+        """Parameters from accumulated float64 statistics."""
+        mass = mass + 10 * torch.finfo(torch.float32).eps
+        means = sums / mass[:, None]
+        if self.covariance_type == 'diag':
+            variances = squares / mass[:, None] - means * means
+        else:
+            variances = ((squares.sum(dim=0) - (mass[:, None] * means * means).sum(dim=0)) / mass.sum()).expand_as(means)
+        self.weights_ = (mass / mass.sum()).float()
+        self.means_ = means.float()
+        self.variances_ = (variances.clamp(min=0) + self.reg_covar).float()
+
+    def _accumulate(self, X, responsibilities):
+        """One streamed pass: statistics of the responsibilities(start, x) -> (resp, log_likelihood) of every chunk."""
+        dim = X.shape[1]
+        mass = torch.zeros(self.n_components, dtype=torch.float64, device=self.device)
+        sums = torch.zeros(self.n_components, dim, dtype=torch.float64, device=self.device)
+        squares = torch.zeros(self.n_components, dim, dtype=torch.float64, device=self.device)
+        log_likelihood = 0.0
+        for start, x in self._chunks(X):
+            resp, chunk_log_likelihood = responsibilities(start, x)
+            mass += resp.sum(dim=0).double()
+            sums += (resp.T @ x).double()
+            squares += (resp.T @ (x * x)).double()
+            log_likelihood += chunk_log_likelihood
+        return mass, sums, squares, log_likelihood / len(X)
+
+    def _e_step(self, start, x):
+        log_prob = self._estimate_weighted_log_prob(x)
+        log_norm = torch.logsumexp(log_prob, dim=1)
+        return torch.exp(log_prob - log_norm[:, None]), float(log_norm.double().sum())
+
+    def _init_responsibilities(self, X):
+        """Hard assignment to k-means++ seeds drawn from a sample of the rows."""
+        rng = np.random.RandomState(self.random_state)
+        sample_size = min(len(X), max(20 * self.n_components, 10000))
+        sample = np.asarray(X[np.sort(rng.choice(len(X), sample_size, replace=False))], dtype=np.float32)
+        centers, _ = kmeans_plusplus(sample, self.n_components, random_state=rng)
+        centers = torch.from_numpy(centers).to(self.device)
+
+        def nearest(start, x):
+            distances = (x * x).sum(dim=1, keepdim=True) - 2.0 * x @ centers.T + (centers * centers).sum(dim=1)
+            resp = torch.zeros(len(x), self.n_components, device=self.device)
+            resp[torch.arange(len(x)), distances.argmin(dim=1)] = 1.0
+            return resp, 0.0
+        return nearest
+
+    def fit(self, X, init_resp=None):
+        """Fits the mixture.
+
+        Args:
+            X (np.ndarray): data, possibly memory-mapped, dimension is (N, D).
+            init_resp (np.ndarray): initial responsibilities, e.g. the model's
+                prob_cat, dimension is (N, n_components); only read by row
+                slices, so a ViewMean works too. k-means++ when None.
+
+        Returns:
+            self (StreamingGMM): the fitted mixture.
+        """
+        if init_resp is not None:
+            if init_resp.shape != (len(X), self.n_components):
+                raise ValueError(f"init_resp has shape {init_resp.shape}, expected {(len(X), self.n_components)}")
+            initial = lambda start, x: (torch.from_numpy(np.array(
+                init_resp[start:start + len(x)], dtype=np.float32)).to(self.device), 0.0)
+        else:
+            initial = self._init_responsibilities(X)
+        self._m_step(*self._accumulate(X, initial)[:3])
+
+        previous = -np.inf
+        for self.n_iter_ in range(1, self.max_iter + 1):
+            mass, sums, squares, log_likelihood = self._accumulate(X, self._e_step)
+            self._m_step(mass, sums, squares)
+            if abs(log_likelihood - previous) < self.tol:
+                break
+            previous = log_likelihood
+        self.lower_bound_ = log_likelihood
+        return self
+
+    def predict(self, X, return_prob=False):
+        """Most likely component of every row, streamed.
+
+        Returns:
+            labels (np.ndarray): int64, (N,).
+            max_prob (np.ndarray): responsibility of that component, if return_prob.
+        """
+        labels = np.empty(len(X), dtype=np.int64)
+        max_prob = np.empty(len(X), dtype=np.float32)
+        for start, x in self._chunks(X):
+            resp, _ = self._e_step(start, x)
+            prob, label = resp.max(dim=1)
+            labels[start:start + len(x)] = label.cpu().numpy()
+            max_prob[start:start + len(x)] = prob.cpu().numpy()
+        if return_prob:
+            return labels, max_prob
+        return labels
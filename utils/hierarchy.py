@@ -0,0 +1,172 @@
+import heapq
+import logging
+import numpy as np
+import leidenalg
+import scipy.sparse as sp
+from typing import Optional
+
+logger = logging.getLogger('Leiden')
+
+
+class LeidenHierarchy:
+    """Merge tree over a fine Leiden partition, cut at any resolution or bin count.
+
+    The graph is partitioned once with RBER Leiden at the finest resolution of
+    interest. The resulting communities are then merged greedily by average
+    linkage on the edge density W_ab / (n_a * n_b), with n the summed node
+    sizes. Merging a and b increases the RBER quality iff
+    W_ab >= resolution * p * n_a * n_b, with p the graph density, so each merge
+    is stored at height W_ab / (n_a * n_b * p): cutting at a resolution applies
+    every merge whose height is at least that resolution. Average linkage is
+    reducible, so heights are non-increasing and every cut is a valid partition.
+
+    Args:
+        membership (np.ndarray): base community of every contig, dimension is (N,).
+        merges (np.ndarray): merged cluster ids per step, dimension is (M, 2);
+            base communities are 0..C-1 and step i creates cluster C + i.
+        heights (np.ndarray): resolution at which every merge happens, (M,).
+        base_resolution (float): resolution of the base Leiden partition.
+    """
+    def __init__(self, membership, merges, heights, base_resolution):
+        self.membership = np.asarray(membership, dtype=np.int32)
+        self.merges = np.asarray(merges, dtype=np.int32).reshape(-1, 2)
+        self.heights = np.asarray(heights, dtype=np.float64)
+        self.base_resolution = float(base_resolution)
+        self.num_communities = int(self.membership.max()) + 1 if len(self.membership) else 0
+
+    @classmethod
+    def build(cls, graph, weights, node_sizes, base_resolution: float = 110.0,
+              is_membership_fixed=None, seed: Optional[int] = None):
+        """Runs the base Leiden partition and the agglomeration on top of it.
+
+        Args:
+            graph (igraph.Graph): undirected kNN graph.
+            weights (np.ndarray): edge weights.
+            node_sizes (np.ndarray): node sizes (contig lengths).
+            base_resolution (float): finest resolution that will be cut.
+            is_membership_fixed (list): contigs whose membership is fixed.
+            seed (int): seed of the Leiden optimiser.
+
+        Returns:
+            hierarchy (LeidenHierarchy).
+        """
+        node_sizes = np.asarray(node_sizes, dtype=np.float64)
+        weights = np.asarray(weights, dtype=np.float64)
+        partition = leidenalg.RBERVertexPartition(graph, weights=weights, resolution_parameter=base_resolution,
+                                                  node_sizes=node_sizes.tolist())
+        optimiser = leidenalg.Optimiser()
+        if seed is not None:
+            optimiser.set_rng_seed(seed)
+        optimiser.optimise_partition(partition, is_membership_fixed=is_membership_fixed, n_iterations=-1)
+        membership = np.asarray(partition.membership, dtype=np.int64)
+
+        # community graph
+        edges = np.asarray(graph.get_edgelist(), dtype=np.int64).reshape(-1, 2)
+        num_communities = int(membership.max()) + 1
+        src, dst = membership[edges[:, 0]], membership[edges[:, 1]]
+        inter = src != dst
+        community_weights = sp.coo_matrix(
+            (np.concatenate((weights[inter], weights[inter])),
+             (np.concatenate((src[inter], dst[inter])), np.concatenate((dst[inter], src[inter])))),
+            shape=(num_communities, num_communities)).tocsr()
+        community_weights.sum_duplicates()
+        sizes = np.bincount(membership, weights=node_sizes, minlength=num_communities)
+        total_size = node_sizes.sum()
+        density = 2.0 * weights.sum() / (total_size * total_size) if total_size > 0 else 1.0
+
+        merges, heights = _average_linkage(community_weights, sizes, density)
+        return cls(membership, merges, heights, base_resolution)
+
+    def save(self, path):
+        np.savez(path, membership=self.membership, merges=self.merges, heights=self.heights,
+                 base_resolution=self.base_resolution)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['membership'], data['merges'], data['heights'], data['base_resolution'])
+
+    def cut(self, resolution: Optional[float] = None, n_bins: Optional[int] = None):
+        """Cuts the hierarchy at a resolution or at a number of bins.
+
+        Resolutions above base_resolution return the base partition; bin
+        counts below the number of connected components are not reachable,
+        return one bin per component and log a warning with that minimum.
+
+        Args:
+            resolution (float): RBER resolution parameter.
+            n_bins (int): requested number of bins.
+
+        Returns:
+            labels (np.ndarray): consecutive int32 bin label of every contig.
+        """
+        if (resolution is None) == (n_bins is None):
+            raise ValueError("Exactly one of resolution and n_bins must be given")
+        if n_bins is not None:
+            min_bins = self.num_communities - len(self.merges)
+            if n_bins < min_bins:
+                logger.warning(f'{n_bins} bins requested, but the graph has {min_bins} components that are '
+                               f'never merged: returning {min_bins} bins, the reachable minimum')
+            num_merges = int(np.clip(self.num_communities - n_bins, 0, len(self.merges)))
+        else:
+            num_merges = int(np.searchsorted(-self.heights, -resolution, side='right'))
+
+        # a cluster is only merged after it was created, so walking the merges backwards
+        # propagates the final root of every cluster down to the base communities
+        root = np.arange(self.num_communities + num_merges)
+        for step in range(num_merges - 1, -1, -1):
+            root[self.merges[step]] = root[self.num_communities + step]
+        roots = root[:self.num_communities]
+        _, community_labels = np.unique(roots, return_inverse=True)
+        return community_labels.astype(np.int32)[self.membership]
+
+
+def _average_linkage(community_weights, sizes, density):
+    """Greedy average-linkage agglomeration on a sparse community graph.
+
+    Only connected communities are merged, so the tree is a forest when the
+    graph has several components.
+
+    Returns:
+        merges (np.ndarray): merged cluster ids, dimension is (M, 2).
+        heights (np.ndarray): merge heights in resolution units, (M,).
+    """
+    num_communities = community_weights.shape[0]
+    coo = sp.triu(community_weights, k=1).tocoo()
+    neighbors = [dict() for _ in range(num_communities)]
+    for a, b, w in zip(coo.row.tolist(), coo.col.tolist(), coo.data.tolist()):
+        neighbors[a][b] = w
+        neighbors[b][a] = w
+    sizes = list(sizes)
+
+    heap = [(-w / (sizes[a] * sizes[b] * density), a, b) for a, b, w in
+            zip(coo.row.tolist(), coo.col.tolist(), coo.data.tolist())]
+    heapq.heapify(heap)
+    active = [True] * num_communities
+    merges, heights = [], []
+    while heap:
+        negative_height, a, b = heapq.heappop(heap)
+        if not (active[a] and active[b]):
+            continue
+        new_id = len(active)
+        active[a] = active[b] = False
+        # merge the smaller neighbor map into the larger one
+        big, small = (neighbors[a], neighbors[b]) if len(neighbors[a]) >= len(neighbors[b]) else (neighbors[b], neighbors[a])
+        merged = big
+        for x, w in small.items():
+            merged[x] = merged.get(x, 0.0) + w
+        merged.pop(a, None)
+        merged.pop(b, None)
+        neighbors[a] = neighbors[b] = None
+        neighbors.append(merged)
+        sizes.append(sizes[a] + sizes[b])
+        active.append(True)
+        for x, w in merged.items():
+            x_neighbors = neighbors[x]
+            x_neighbors.pop(a, None)
+            x_neighbors.pop(b, None)
+            x_neighbors[new_id] = w
+            heapq.heappush(heap, (-w / (sizes[new_id] * sizes[x] * density), min(x, new_id), max(x, new_id)))
+        merges.append((a, b))
+        heights.append(-negative_height)
+    return np.asarray(merges, dtype=np.int32).reshape(-1, 2), np.asarray(heights, dtype=np.float64)
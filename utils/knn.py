@@ -0,0 +1,232 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import hnswlib
+import numpy as np
+from threadpoolctl import threadpool_limits
+logger = logging.getLogger('KNN')
+logger.setLevel(logging.INFO)
+
+
+def latent_fingerprint(latent: np.ndarray, chunk_size: int = 65536) -> str:
+    """
+    Content hash of a latent matrix, streamed chunk by chunk so memory-mapped inputs stay on disk.
+
+    :param latent: The (N, D) latent matrix.
+    :param chunk_size: Number of rows hashed at a time (default: 65536).
+
+    :return: Hex digest identifying shape, dtype and content of the matrix.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f'{latent.shape}{latent.dtype}'.encode())
+    for start in range(0, len(latent), chunk_size):
+        h.update(np.ascontiguousarray(latent[start:start + chunk_size]).data)
+    return h.hexdigest()
+
+
+def _params_key(fingerprint: str, **params) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    h.update(fingerprint.encode())
+    h.update(json.dumps(params, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def _save_array(path: str, array: np.ndarray):
+    # write then rename, so an interrupted run never leaves a truncated cache entry
+    tmp_path = path + '.tmp.npy'
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
+
+
+def build_hnsw_index(latent: np.ndarray, num_threads: int, ef: int = 100, M: int = 16,
+                     space: str = 'l2', index_path: str = None) -> hnswlib.Index:
+    """
+    Build an HNSW index over the latent matrix, or load it from index_path when it exists.
+
+    :param latent: The (N, D) float32 latent matrix.
+    :param num_threads: Number of threads used for insertion.
+    :param ef: ef_construction and query ef of the index (default: 100).
+    :param M: The M parameter of the HNSW graph (default: 16).
+    :param space: The space in which the index operates (default: 'l2').
+    :param index_path: Path to load the index from or save it to (optional).
+
+    :return: The HNSW index.
+    """
+    p = hnswlib.Index(space=space, dim=latent.shape[1])
+    if index_path is not None and os.path.exists(index_path):
+        p.load_index(index_path, max_elements=len(latent))
+    else:
+        p.init_index(max_elements=len(latent), ef_construction=ef, M=M)
+        p.add_items(latent, np.arange(len(latent)), num_threads=num_threads)
+        if index_path is not None:
+            p.save_index(index_path + '.tmp')
+            os.replace(index_path + '.tmp', index_path)
+    p.set_ef(ef)
+    return p
+
+
+def _exact_knn_block(latent, sq_norms, q_start, k, query_block, reference_block):
+    q = latent[q_start:q_start + query_block]
+    q_rows = np.arange(len(q))
+    best_d = np.empty((len(q), 0), dtype=np.float32)
+    best_i = np.empty((len(q), 0), dtype=np.int64)
+    for r_start in range(0, len(latent), reference_block):
+        r = latent[r_start:r_start + reference_block]
+        d = q @ r.T
+        d *= -2
+        d += sq_norms[r_start:r_start + len(r)]
+        d += sq_norms[q_start:q_start + len(q), None]
+        # pin the query to distance -1 in its own tile, so it ranks first despite rounding
+        self_cols = q_rows + (q_start - r_start)
+        in_tile = (self_cols >= 0) & (self_cols < len(r))
+        d[q_rows[in_tile], self_cols[in_tile]] = -1
+        # select the k winners of the tile on d alone, then merge them with the running k
+        if len(r) > k:
+            pos = np.argpartition(d, k - 1, axis=1)[:, :k]
+            tile_d = np.take_along_axis(d, pos, axis=1)
+            tile_i = pos + r_start
+        else:
+            tile_d = d
+            tile_i = np.broadcast_to(np.arange(r_start, r_start + len(r)), d.shape)
+        del d
+        cand_d = np.concatenate((best_d, tile_d), axis=1)
+        cand_i = np.concatenate((best_i, tile_i), axis=1)
+        if cand_d.shape[1] > k:
+            pos = np.argpartition(cand_d, k - 1, axis=1)[:, :k]
+            cand_d = np.take_along_axis(cand_d, pos, axis=1)
+            cand_i = np.take_along_axis(cand_i, pos, axis=1)
+        best_d, best_i = cand_d, cand_i
+    order = np.argsort(best_d, axis=1, kind='stable')
+    best_d = np.take_along_axis(best_d, order, axis=1)
+    return np.take_along_axis(best_i, order, axis=1), np.maximum(best_d, 0, out=best_d)
+
+
+def exact_knn(latent: np.ndarray, k: int, num_threads: int, query_block: int = 256, reference_block: int = 8192,
+              memory_budget: float = 2e9):
+    """
+    Exact k nearest neighbors under squared l2, by tiled matrix products.
+
+    Queries and references are processed in (query_block, reference_block) tiles. Every tile keeps only
+    its k best candidates (argpartition on the tile alone), merged with the running 2k candidates of the
+    query block. A tile in flight holds about 12 * query_block * reference_block bytes (float32
+    distances plus int64 argpartition output), 25 MB with the defaults, and the number of worker threads
+    is capped by the core count and memory_budget, so the N x N matrix is never formed. Each worker runs
+    a single-threaded BLAS. Every query is returned as its own first neighbor.
+
+    :param latent: The (N, D) float32 latent matrix.
+    :param k: Number of neighbors returned, including the query itself.
+    :param num_threads: Requested number of worker threads.
+    :param query_block: Number of query rows per tile (default: 256).
+    :param reference_block: Number of reference rows per tile (default: 8192).
+    :param memory_budget: Bytes of tile buffers allowed in flight across workers (default: 2e9).
+
+    :return: Neighbor indices (N, k) and squared l2 distances (N, k), as returned by hnswlib's 'l2' space.
+    """
+    latent = np.ascontiguousarray(latent, dtype=np.float32)
+    num_samples = len(latent)
+    k = min(k, num_samples)
+    sq_norms = np.einsum('ij,ij->i', latent, latent)
+    indices = np.empty((num_samples, k), dtype=np.int64)
+    distances = np.empty((num_samples, k), dtype=np.float32)
+
+    def run(q_start):
+        block_indices, block_distances = _exact_knn_block(latent, sq_norms, q_start, k, query_block, reference_block)
+        indices[q_start:q_start + len(block_indices)] = block_indices
+        distances[q_start:q_start + len(block_indices)] = block_distances
+
+    num_blocks = -(-num_samples // query_block)
+    tile_bytes = 12 * query_block * (min(reference_block, num_samples) + 2 * k)
+    num_workers = max(1, min(num_threads, os.cpu_count() or 1, num_blocks, int(memory_budget // tile_bytes)))
+    with threadpool_limits(limits=1, user_api='blas'), ThreadPoolExecutor(max_workers=num_workers) as pool:
+        list(pool.map(run, range(0, num_samples, query_block)))
+    return indices, distances
+
+
+def choose_backend(num_samples: int, dim: int, num_threads: int, space: str = 'l2',
+                   max_exact: int = 200000, flop_budget: float = 2e12) -> str:
+    """
+    Pick the exact or the HNSW kNN backend from the problem size.
+
+    Exact search costs about 2 * N^2 * D flops spread over the threads; it is used when that stays below
+    flop_budget per thread (about a minute of BLAS time) and N is below max_exact, where it is both
+    faster than building an HNSW index and free of approximation noise.
+
+    :param num_samples: Number of rows N.
+    :param dim: Dimension D.
+    :param num_threads: Number of available threads.
+    :param space: Distance space, exact search supports 'l2' only (default: 'l2').
+    :param max_exact: Largest N searched exactly (default: 200000).
+    :param flop_budget: Largest exact cost per thread, in flops (default: 2e12).
+
+    :return: 'exact' or 'hnsw'.
+    """
+    if space != 'l2' or num_samples > max_exact:
+        return 'hnsw'
+    return 'exact' if 2.0 * num_samples * num_samples * dim / max(num_threads, 1) <= flop_budget else 'hnsw'
+
+
+def cached_knn(latent: np.ndarray, k: int, num_threads: int, cache_dir: str = None,
+               ef: int = None, M: int = 16, space: str = 'l2', fingerprint: str = None, backend: str = 'auto'):
+    """
+    k nearest neighbors of every row of the latent matrix, cached on disk.
+
+    Small and medium inputs are searched exactly (see choose_backend), larger ones with HNSW.
+    The HNSW index is keyed by a content hash of the latent and the index parameters, the
+    (indices, distances) arrays additionally by k. Cached arrays are returned memory-mapped,
+    so parameter sweeps and reruns on the same latent skip index build and query.
+
+    :param latent: The (N, D) latent matrix.
+    :param k: Number of neighbors returned, including the query itself.
+    :param num_threads: Number of threads for index build and query.
+    :param cache_dir: Directory holding the cache, None disables caching (default: None).
+    :param ef: ef parameter of the index, defaults to 10 * k.
+    :param M: The M parameter of the HNSW graph (default: 16).
+    :param space: The space in which the index operates (default: 'l2').
+    :param fingerprint: Precomputed latent_fingerprint of the latent (optional).
+    :param backend: 'exact', 'hnsw' or 'auto' to decide with choose_backend (default: 'auto').
+
+    :return: Neighbor indices (N, k) and distances (N, k).
+    """
+    latent = np.ascontiguousarray(latent, dtype=np.float32)
+    if ef is None:
+        ef = k * 10
+    index_dtype = np.int32 if len(latent) < np.iinfo(np.int32).max else np.int64
+    if backend == 'auto':
+        backend = choose_backend(latent.shape[0], latent.shape[1], num_threads, space=space)
+
+    if cache_dir is None:
+        if backend == 'exact':
+            indices, distances = exact_knn(latent, k, num_threads)
+        else:
+            p = build_hnsw_index(latent, num_threads, ef=ef, M=M, space=space)
+            indices, distances = p.knn_query(latent, k, num_threads=num_threads)
+        return indices.astype(index_dtype), distances
+
+    os.makedirs(cache_dir, exist_ok=True)
+    time_start = time.time()
+    fingerprint = fingerprint or latent_fingerprint(latent)
+    if backend == 'exact':
+        knn_key = _params_key(fingerprint, backend=backend, k=k)
+    else:
+        index_key = _params_key(fingerprint, ef=ef, M=M, space=space)
+        knn_key = _params_key(index_key, k=k)
+    indices_path = os.path.join(cache_dir, f'knn_{knn_key}_indices.npy')
+    distances_path = os.path.join(cache_dir, f'knn_{knn_key}_distances.npy')
+
+    if os.path.exists(indices_path) and os.path.exists(distances_path):
+        logger.info(f'knn cache hit {knn_key}:\t{time.time() - time_start}s')
+        return np.load(indices_path, mmap_mode='r'), np.load(distances_path, mmap_mode='r')
+
+    if backend == 'exact':
+        indices, distances = exact_knn(latent, k, num_threads)
+    else:
+        p = build_hnsw_index(latent, num_threads, ef=ef, M=M, space=space,
+                             index_path=os.path.join(cache_dir, f'hnsw_{index_key}.bin'))
+        indices, distances = p.knn_query(latent, k, num_threads=num_threads)
+    _save_array(indices_path, indices.astype(index_dtype))
+    _save_array(distances_path, distances)
+    logger.info(f'knn cache miss {knn_key}, {backend} search:\t{time.time() - time_start}s')
+    return np.load(indices_path, mmap_mode='r'), np.load(distances_path, mmap_mode='r')
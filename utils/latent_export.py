@@ -0,0 +1,113 @@
+import os
+import numpy as np
+from utils.knn import latent_fingerprint
+
+
+def fit_pca_projection(latent, n_components, chunk_size=65536):
+    """Fits a PCA projection of the latent matrix in a single streamed pass.
+
+    The D x D covariance is accumulated chunk by chunk in float64 and
+    eigendecomposed, so the N x D matrix (possibly memory-mapped) is never
+    copied in full.
+
+    Args:
+        latent (np.ndarray): latent matrix, dimension is (N, D).
+        n_components (int): output dimension of the projection.
+        chunk_size (int): number of rows read per chunk.
+
+    Returns:
+        projection (dict): 'mean' (D,), 'components' (n_components, D) and
+            'explained_variance' (n_components,).
+    """
+    num_samples, dim = latent.shape
+    if n_components > dim:
+        raise ValueError(f"n_components ({n_components}) exceeds latent dimension ({dim})")
+    total = np.zeros(dim, dtype=np.float64)
+    gram = np.zeros((dim, dim), dtype=np.float64)
+    for start in range(0, num_samples, chunk_size):
+        chunk = np.asarray(latent[start:start + chunk_size], dtype=np.float64)
+        total += chunk.sum(axis=0)
+        gram += chunk.T @ chunk
+    mean = total / num_samples
+    covariance = gram / num_samples - np.outer(mean, mean)
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+    order = np.argsort(eigenvalues)[::-1][:n_components]
+    return {
+        "mean": mean.astype(np.float32),
+        "components": eigenvectors[:, order].T.astype(np.float32),
+        "explained_variance": eigenvalues[order].astype(np.float32),
+    }
+
+
+def save_projection(path, projection):
+    np.savez(path, **projection)
+
+
+def load_projection(path):
+    with np.load(path) as data:
+        return {key: data[key] for key in data.files}
+
+
+def export_compact_latent(latent_path, output_path, dtype="float16", n_components=None,
+                          projection_path=None, chunk_size=65536):
+    """Writes a compact copy of latent.npy for clustering.
+
+    Args:
+        latent_path (string): path of the float32 latent.npy.
+        output_path (string): path of the compact latent to write (.npy).
+        dtype (string): 'float16' or 'float32' storage of the output.
+        n_components (int): dimension of the PCA projection, None keeps all
+            dimensions.
+        projection_path (string): .npz holding the projection; reused when it
+            was fitted on the same latent content with the same n_components,
+            otherwise (re)fitted on latent_path and saved there.
+        chunk_size (int): number of rows processed per chunk.
+
+    Returns:
+        output_path (string): path of the written latent.
+    """
+    latent = np.load(latent_path, mmap_mode="r")
+    projection = None
+    if n_components:
+        fingerprint = latent_fingerprint(latent, chunk_size=chunk_size)
+        if projection_path is not None and os.path.exists(projection_path):
+            projection = load_projection(projection_path)
+            # a projection left over from another training run or latent_dim is refitted
+            if (str(projection.get("fingerprint", "")) != fingerprint
+                    or projection["components"].shape[0] != n_components):
+                projection = None
+        if projection is None:
+            projection = fit_pca_projection(latent, n_components, chunk_size=chunk_size)
+            projection["fingerprint"] = np.array(fingerprint)
+            if projection_path is not None:
+                save_projection(projection_path, projection)
+        out_dim = projection["components"].shape[0]
+    else:
+        out_dim = latent.shape[1]
+
+    compact = np.lib.format.open_memmap(
+        output_path, mode="w+", dtype=np.dtype(dtype), shape=(latent.shape[0], out_dim))
+    for start in range(0, latent.shape[0], chunk_size):
+        chunk = np.asarray(latent[start:start + chunk_size], dtype=np.float32)
+        if projection is not None:
+            chunk = (chunk - projection["mean"]) @ projection["components"].T
+        compact[start:start + len(chunk)] = chunk
+    compact.flush()
+    del compact
+    return output_path
+
+
+def load_latent(path, mmap_mode=None):
+    """Loads a full or compact latent as float32, as expected by hnswlib.
+
+    Args:
+        path (string): path of latent.npy or of a compact export.
+        mmap_mode (string): forwarded to np.load, float32 files stay mapped.
+
+    Returns:
+        latent (np.ndarray): latent matrix in float32.
+    """
+    latent = np.load(path, mmap_mode=mmap_mode)
+    if latent.dtype != np.float32:
+        latent = latent.astype(np.float32)
+    return latent
@@ -1,11 +1,12 @@
 import leidenalg
 from leidenalg import RBERVertexPartition, Optimiser
-import scanpy as sc
 from igraph import Graph
 import hnswlib
 import numpy as np
 import pandas as pd
 import functools
+import collections
+import queue
 import time
 import os
 import logging
@@ -15,6 +16,10 @@ import scipy.sparse as sp
 from sklearn.cluster._kmeans import euclidean_distances, stable_cumsum, KMeans, check_random_state, row_norms, MiniBatchKMeans
 from typing import List, Optional, Union
 from utils.utils import gen_seed
+from utils.knn import cached_knn, latent_fingerprint, _params_key
+from utils.hierarchy import LeidenHierarchy
+from utils.shared_arrays import SharedArrays, attach_shared_arrays, shared_array, has_shared_array
+from utils.quality import MarkerScorer, PlateauTracker, select_partition
 logger = logging.getLogger('Leiden')
 logger.setLevel(logging.INFO)
 
@@ -89,61 +94,90 @@ def hnsw_index(features,num_threads, ef: int = 100, M: int = 16,
     return p
 
 def leiden_clustering_scanpy(anndata, resolution=1.0, random_state = 0, n_iterations = -1):
+    # scanpy is only needed for this legacy path and takes seconds to import
+    import scanpy as sc
     anndata_neibour = sc.pp.neighbors(anndata, n_neighbors=5, n_pcs=None, use_rep=None, knn=True, method='gauss', transformer=None, metric='l2', random_state=0, key_added=None, copy=True)
     anndata_clustered = sc.tl.leiden(anndata_neibour, resolution=resolution, restrict_to=None, random_state=random_state, key_added='leiden', adjacency=None, directed=None, use_weights=True, n_iterations=n_iterations, partition_type=None, neighbors_key=None, obsp=None, copy=True, flavor='leidenalg')
     return anndata_clustered
     
+def knn_edges(ann_neighbor_indices: np.ndarray, ann_distances: np.ndarray, max_edges: int,
+              partgraph_ratio: int = 50):
+    """
+    Undirected edges of the Leiden graph from kNN query results, with vectorised numpy operations.
+
+    :param ann_neighbor_indices: Array of ANN neighbor indices, first column is the query itself.
+    :param ann_distances: Array of ANN (squared l2) distances.
+    :param max_edges: Number of neighbors kept per contig.
+    :param partgraph_ratio: Percentile of the distances kept as edges (default: 50).
+
+    :return: Contiguous int32 (E, 2) edge array and the float64 distance of every edge.
+
+    Distances above the partgraph_ratio percentile and self loops are dropped. A neighbor pair found
+    from both ends (mutual neighbors) or more than once becomes a single undirected edge with its
+    smallest distance, so every pair is kept whichever end found it.
+    """
+    vcount = ann_neighbor_indices.shape[0]
+    targets = np.asarray(ann_neighbor_indices)[:, 1:max_edges + 1].astype(np.int32).ravel()
+    wei = np.asarray(ann_distances)[:, 1:max_edges + 1].astype(np.float64).ravel()
+    sources = np.repeat(np.arange(vcount, dtype=np.int32), len(targets) // vcount)
+
+    keep = sources != targets
+    if partgraph_ratio < 100:
+        keep &= wei <= np.percentile(wei, partgraph_ratio)
+    # undirected int64 key min * vcount + max, equal for (a, b) and (b, a)
+    key = np.minimum(sources, targets)[keep].astype(np.int64) * vcount + np.maximum(sources, targets)[keep]
+    order = np.argsort(key)
+    key = key[order]
+    # keys are >= 1 once self loops are gone, so prepending -1 marks the first edge as well
+    first = np.flatnonzero(np.diff(key, prepend=-1))
+    wei = np.minimum.reduceat(wei[keep][order], first)
+    key = key[first]
+    edges = np.column_stack(((key // vcount).astype(np.int32), (key % vcount).astype(np.int32)))
+    return edges, wei
+
+def edge_weights(distances: np.ndarray, bandwidth: float = 0.1, lmode: Optional[str] = 'l2'):
+    """
+    Apply the distance kernel ('l1', 'l2' or None for raw distances) to edge distances.
+    """
+    if lmode == 'l1':
+        return np.exp(-np.sqrt(distances) / bandwidth)
+    if lmode == 'l2':
+        return np.exp(-distances / bandwidth)
+    return distances
+
+def build_knn_graph(ann_neighbor_indices: np.ndarray, ann_distances: np.ndarray, max_edges: int,
+                    partgraph_ratio: int = 50, bandwidth: float = 0.1, lmode: Optional[str] = 'l2'):
+    """
+    Build the weighted Leiden graph from kNN query results, see knn_edges.
+
+    :param ann_neighbor_indices: Array of ANN neighbor indices, first column is the query itself.
+    :param ann_distances: Array of ANN (squared l2) distances.
+    :param max_edges: Number of neighbors kept per contig.
+    :param partgraph_ratio: Percentile of the distances kept as edges (default: 50).
+    :param bandwidth: Bandwidth of the exponential kernel (default: 0.1).
+    :param lmode: Kernel applied to the distances ('l1', 'l2' or None for raw distances, default: 'l2').
+
+    :return: The igraph Graph and its edge weights as a float64 numpy array.
+
+    Edges go to igraph as one contiguous int32 (E, 2) array, without intermediate python tuples.
+    """
+    edges, distances = knn_edges(ann_neighbor_indices, ann_distances, max_edges, partgraph_ratio=partgraph_ratio)
+    g = Graph(ann_neighbor_indices.shape[0])
+    g.add_edges(edges)
+    return g, edge_weights(distances, bandwidth=bandwidth, lmode=lmode)
+
 def leiden_clustering_alg(namelist, ann_neighbor_indices, ann_distances, length_weight, max_edges, latent, bandwidth: float=0.1, lmode='l2', initial_list=None, is_membership_fixed=None, resolution_parameter=1.0, partgraph_ratio=50):
-    sources = np.repeat(np.arange(len(latent)), max_edges)
-    targets_indices = ann_neighbor_indices[:, 1:]
-    targets = targets_indices.flatten()
-    wei = ann_distances[:, 1:]
-    wei = wei.flatten()
-    dist_cutoff = np.percentile(wei, partgraph_ratio)
-    save_index = wei <= dist_cutoff
-
-    sources = sources[save_index]
-    targets = targets[save_index]
-    wei = wei[save_index]
-
-    # if lmode == 'l1':
-    #     wei = np.sqrt(wei)
-    #     wei = np.exp(-wei / bandwidth)
-
-    # if lmode == 'l2':
-    #     wei = np.exp(-wei / bandwidth)
-
-    index = sources > targets
-    sources = sources[index]
-    targets = targets[index]
-    wei = wei[index]
-
-    vcount = len(latent)
-    edgelist = list(zip(sources, targets))
-    g = Graph(vcount, edgelist)
+    # the distance kernel is intentionally not applied here, raw distances are used as weights
+    g, wei = build_knn_graph(ann_neighbor_indices, ann_distances, max_edges,
+                             partgraph_ratio=partgraph_ratio, bandwidth=bandwidth, lmode=None)
 
     res = RBERVertexPartition(g, weights=wei, initial_membership=None, resolution_parameter=resolution_parameter, node_sizes=length_weight)
 
     optimiser = Optimiser()
     optimiser.optimise_partition(res, is_membership_fixed=is_membership_fixed, n_iterations=-1)
 
-    part = list(res)
-
-    # contig_labels_dict = {}
-    # numnode = 0
-    # for ci in range(len(part)):
-    #     numnode = numnode + len(part[ci])
-    #     for id in part[ci]:
-    #         contig_labels_dict[namelist[id]] = 'group' + str(ci)
-    
-    # return contig_labels_dict
-
-    contig_labels_list = []  # 存储标签的列表
-    for ci in range(len(part)):
-        for id in part[ci]:
-            contig_labels_list.append(str(ci))
-
-    return contig_labels_list
+    # labels in vertex (contig) order
+    return [str(ci) for ci in res.membership]
 
 def gen_seed_idx(seedURL: str, contig_id_list: List[str]) -> List[int]:
     """
@@ -163,14 +197,16 @@ def gen_seed_idx(seedURL: str, contig_id_list: List[str]) -> List[int]:
     return seed_idx
 
 def get_length_weight(contignames):
-    length_list = np.array([int(np.char.find(name, 'length_') + 7) for name in contignames])
-    return length_list
-
-def cluster(latent, contignames, threads, max_edges = 100, prefix=None):
+    # contig length from the assembler header (NODE_1_length_1234_cov_...), 1 when absent
+    lengths = pd.Series(np.asarray(contignames).astype(str)).str.extract(r'length_(\d+)', expand=False)
+    return lengths.fillna(1).astype(np.int64).to_numpy()
 
-    p = hnsw_index(latent, threads, ef=max_edges * 10)
-
-    ann_neighbor_indices, ann_distances = p.knn_query(latent, max_edges + 1, num_threads=threads)
+def cluster(latent, contignames, threads, max_edges = 100, prefix=None, cache_dir=None):
+    # accepts the full or the compact (float16 / PCA projected) latent export
+    latent = np.ascontiguousarray(latent, dtype=np.float32)
+    time_start = time.time()
+    ann_neighbor_indices, ann_distances = cached_knn(latent, max_edges + 1, threads, cache_dir=cache_dir, ef=max_edges * 10)
+    logger.info(f'hnsw build and query on {latent.shape} latent:\t{time.time() - time_start}s')
     length_weight = get_length_weight(contignames)
 
     norm_embeddings = normalize(latent)
@@ -178,6 +214,85 @@ def cluster(latent, contignames, threads, max_edges = 100, prefix=None):
     return leiden_clustering_alg(contignames, ann_neighbor_indices, ann_distances, length_weight, max_edges, norm_embeddings,
                                                                         bandwidth = 0.1, lmode = 'l2', partgraph_ratio = 50)
 
+def leiden_cluster(latent, contignames, threads, max_edges: int = 100, partgraph_ratio: int = 100,
+                   bandwidth: float = 0.1, resolution_parameter: float = 1.0, cache_dir: Optional[str] = None,
+                   seed: Optional[int] = 0):
+    """
+    Cluster the latent with cached kNN, the vectorised graph build and length-weighted RBER Leiden.
+
+    Lean replacement of the scanpy path (AnnData, sc.pp.neighbors, sc.tl.leiden): no object copies,
+    and thread count, kNN cache and node sizes are explicit.
+
+    :param latent: The (N, D) latent matrix.
+    :param contignames: Contig names, used for the length node sizes.
+    :param threads: Number of threads for the kNN search.
+    :param max_edges: Maximum number of edges per contig (default: 100).
+    :param partgraph_ratio: Percentile of the distances kept as edges (default: 100, all neighbors; lower
+        cutoffs split the graph into many small components at resolution 1.0).
+    :param bandwidth: Bandwidth of the exponential kernel (default: 0.1).
+    :param resolution_parameter: RBER resolution (default: 1.0).
+    :param cache_dir: Directory where the kNN result is persisted (optional).
+    :param seed: Seed of the Leiden optimiser, None for a random one (default: 0).
+
+    :return: int32 cluster label of every contig.
+    """
+    norm_embeddings = normalize(np.asarray(latent, dtype=np.float32))
+    time_start = time.time()
+    ann_neighbor_indices, ann_distances = cached_knn(norm_embeddings, max_edges + 1, threads, cache_dir=cache_dir,
+                                                     ef=max_edges * 10)
+    logger.info(f'knn on {norm_embeddings.shape} latent:\t{time.time() - time_start}s')
+    time_start = time.time()
+    g, wei = build_knn_graph(ann_neighbor_indices, ann_distances, max_edges,
+                             partgraph_ratio=partgraph_ratio, bandwidth=bandwidth, lmode='l2')
+    res = RBERVertexPartition(g, weights=wei, resolution_parameter=resolution_parameter,
+                              node_sizes=get_length_weight(contignames).tolist())
+    optimiser = Optimiser()
+    if seed is not None:
+        optimiser.set_rng_seed(seed)
+    optimiser.optimise_partition(res, n_iterations=-1)
+    logger.info(f'graph build and leiden ({g.ecount()} edges):\t{time.time() - time_start}s')
+    return np.asarray(res.membership, dtype=np.int32)
+
+def cluster_hierarchy(latent, contignames, threads, max_edges: int = 100, partgraph_ratio: int = 100,
+                      bandwidth: float = 0.1, base_resolution: float = 110, cache_dir: Optional[str] = None):
+    """
+    Build (or load) the Leiden merge hierarchy of the latent, to cut partitions at any resolution or bin count.
+
+    :param latent: The (N, D) latent matrix.
+    :param contignames: Contig names, used for the length node sizes.
+    :param threads: Number of threads for the kNN search.
+    :param max_edges: Maximum number of edges per contig (default: 100).
+    :param partgraph_ratio: Percentile of the distances kept as edges (default: 100, all neighbors).
+    :param bandwidth: Bandwidth of the exponential kernel (default: 0.1).
+    :param base_resolution: Finest resolution of the hierarchy (default: 110).
+    :param cache_dir: Directory where the kNN result and the hierarchy are persisted (optional).
+
+    :return: The LeidenHierarchy.
+    """
+    norm_embeddings = normalize(np.asarray(latent, dtype=np.float32))
+    length_weight = get_length_weight(contignames)
+    fingerprint = latent_fingerprint(norm_embeddings) if cache_dir is not None else None
+    hierarchy_path = None
+    if cache_dir is not None:
+        # the tree depends on the node sizes too, not only on the latent and graph parameters
+        key = _params_key(fingerprint, max_edges=max_edges, partgraph_ratio=partgraph_ratio,
+                          bandwidth=bandwidth, base_resolution=base_resolution,
+                          node_sizes=latent_fingerprint(np.asarray(length_weight, dtype=np.int64).reshape(-1, 1)))
+        hierarchy_path = os.path.join(cache_dir, f'leiden_hierarchy_{key}.npz')
+        if os.path.exists(hierarchy_path):
+            return LeidenHierarchy.load(hierarchy_path)
+
+    ann_neighbor_indices, ann_distances = cached_knn(norm_embeddings, max_edges + 1, threads, cache_dir=cache_dir,
+                                                     ef=max_edges * 10, fingerprint=fingerprint)
+    g, wei = build_knn_graph(ann_neighbor_indices, ann_distances, max_edges,
+                             partgraph_ratio=partgraph_ratio, bandwidth=bandwidth, lmode='l2')
+    time_start = time.time()
+    hierarchy = LeidenHierarchy.build(g, wei, length_weight, base_resolution=base_resolution)
+    logger.info(f'leiden hierarchy with {hierarchy.num_communities} base communities:\t{time.time() - time_start}s')
+    if hierarchy_path is not None:
+        hierarchy.save(hierarchy_path)
+    return hierarchy
+
 def run_leiden(output_file: str, namelist: List[str],
                ann_neighbor_indices: np.ndarray, ann_distances: np.ndarray,
                length_weight: List[float], max_edges: int, norm_embeddings: np.ndarray,
@@ -204,33 +319,8 @@ def run_leiden(output_file: str, namelist: List[str],
     :return: None
     """
 
-    sources = np.repeat(np.arange(len(norm_embeddings)), max_edges)
-    targets_indices = ann_neighbor_indices[:,1:]
-    targets = targets_indices.flatten()
-    wei = ann_distances[:,1:]
-    wei = wei.flatten()
-
-    dist_cutoff = np.percentile(wei, partgraph_ratio)
-    save_index = wei <= dist_cutoff
-
-    sources = sources[save_index]
-    targets = targets[save_index]
-    wei = wei[save_index]
-
-    if lmode == 'l1':
-        wei = np.sqrt(wei)
-        wei = np.exp(-wei / bandwidth)
-
-    if lmode == 'l2':
-        wei = np.exp(-wei / bandwidth)
-
-    index = sources > targets
-    sources = sources[index]
-    targets = targets[index]
-    wei = wei[index]
-    vcount = len(norm_embeddings)
-    edgelist = list(zip(sources, targets))
-    g = Graph(vcount, edgelist)
+    g, wei = build_knn_graph(ann_neighbor_indices, ann_distances, max_edges,
+                             partgraph_ratio=partgraph_ratio, bandwidth=bandwidth, lmode=lmode)
 
     res = leidenalg.RBERVertexPartition(g,
                                         weights=wei, initial_membership = initial_list,
@@ -239,26 +329,157 @@ def run_leiden(output_file: str, namelist: List[str],
     optimiser = leidenalg.Optimiser()
     optimiser.optimise_partition(res, is_membership_fixed=is_membership_fixed,n_iterations=-1)
 
-    part = list(res)
+    logger.info(output_file)
+    with open(output_file, 'w') as f:
+        for contig_idx, ci in enumerate(res.membership):
+            f.write(namelist[contig_idx] + "\t" + 'group' + str(ci) + "\n")
+
+# (partgraph_ratio, graph) last built by a sweep worker
+_SWEEP_GRAPH = None
 
+def _sweep_task(max_edges: int, partgraph_ratio: int, bandwidth: float, resolution_parameter: float):
+    """
+    Run Leiden for one (graph, resolution) pair on the shared edge arrays of the graph.
 
-    contig_labels_dict ={}
-    # dict of communities
-    numnode = 0
-    rang = []
-    for ci in range(len(part)):
-        rang.append(ci)
-        numnode = numnode+len(part[ci])
-        for id in part[ci]:
-            contig_labels_dict[namelist[id]] = 'group'+str(ci)
+    The edges and distances of every partgraph_ratio are computed once by leiden_sweep. The bandwidth
+    only changes the weights, so the worker keeps the igraph Graph of the last ratio it used for all
+    bandwidths and resolutions of that ratio.
 
-    logger.info(output_file)
-    f = open(output_file, 'w')
-    for contigIdx in range(len(contig_labels_dict)):
-        f.write(namelist[contigIdx] + "\t" + str(contig_labels_dict[namelist[contigIdx]]) + "\n")
-    f.close()
+    :return: The graph parameters, the resolution, int32 labels and their marker score (None without markers).
+    """
+    global _SWEEP_GRAPH
+    if _SWEEP_GRAPH is None or _SWEEP_GRAPH[0] != partgraph_ratio:
+        _SWEEP_GRAPH = None
+        g = Graph(len(shared_array('length_weight')))
+        g.add_edges(shared_array(f'edges_{partgraph_ratio}'))
+        _SWEEP_GRAPH = (partgraph_ratio, g)
+    g = _SWEEP_GRAPH[1]
+    wei = edge_weights(shared_array(f'distances_{partgraph_ratio}'), bandwidth=bandwidth, lmode='l2')
+    res = leidenalg.RBERVertexPartition(g, weights=wei, resolution_parameter=resolution_parameter,
+                                        node_sizes=shared_array('length_weight').tolist())
+    optimiser = leidenalg.Optimiser()
+    optimiser.optimise_partition(res, is_membership_fixed=shared_array('is_membership_fixed').tolist(),
+                                 n_iterations=-1)
+    labels = np.asarray(res.membership, dtype=np.int32)
+    score = None
+    if has_shared_array('marker_contigs'):
+        scorer = MarkerScorer(shared_array('marker_contigs'), shared_array('marker_genes'),
+                              int(shared_array('marker_num_genes')[0]),
+                              shared_array('marker_hits') if has_shared_array('marker_hits') else None)
+        score = scorer.score(labels)
+    return (max_edges, partgraph_ratio, bandwidth), resolution_parameter, labels, score
+
+def leiden_sweep(ann_neighbor_indices: np.ndarray, ann_distances: np.ndarray, length_weight: np.ndarray,
+                 max_edges: int, partgraph_ratio_list: List[int], bandwidth_list: List[float],
+                 resolution_list: List[float], is_membership_fixed: Optional[np.ndarray] = None,
+                 num_workers: int = 16, marker_scorer: Optional[MarkerScorer] = None, patience: int = 2):
+    """
+    Run a Leiden parameter sweep on graphs built once and placed in shared memory.
 
-def leiden_tuning(namelist, contig_path, latent, output_path):
+    The edges of every distinct partgraph_ratio are computed once in this process and published as
+    int32 edge and float64 distance arrays; the bandwidths of a ratio share them and only differ by
+    their weights. Every (graph, resolution) pair is then a task on those shared arrays, and workers
+    return compact int32 label arrays.
+
+    With a marker_scorer, a graph's resolutions are submitted in plateau order and at most `patience`
+    of them run ahead of its plateau check, so once its score plateaus the remaining resolutions are
+    never run.
+
+    :param ann_neighbor_indices: Array of ANN neighbor indices.
+    :param ann_distances: Array of ANN distances.
+    :param length_weight: Node sizes (contig lengths).
+    :param max_edges: Maximum number of edges per contig.
+    :param partgraph_ratio_list: Percentile cutoffs to sweep.
+    :param bandwidth_list: Kernel bandwidths to sweep.
+    :param resolution_list: Resolution parameters to sweep, in the order the plateau is evaluated.
+    :param is_membership_fixed: Boolean mask of contigs whose membership is fixed (optional).
+    :param num_workers: Maximum number of worker processes (default: 16).
+    :param marker_scorer: Scores partitions by marker quality; when given, a graph stops once its score
+        plateaus and only its best partition is returned (optional).
+    :param patience: Resolutions without improvement before a graph stops (default: 2).
+
+    :return: Dict mapping (max_edges, partgraph_ratio, bandwidth, resolution) to an int32 label array.
+    """
+    vcount = len(ann_neighbor_indices)
+    if is_membership_fixed is None:
+        is_membership_fixed = np.zeros(vcount, dtype=bool)
+    arrays = {
+        'length_weight': np.asarray(length_weight),
+        'is_membership_fixed': np.asarray(is_membership_fixed, dtype=bool),
+    }
+    time_start = time.time()
+    for partgraph_ratio in dict.fromkeys(partgraph_ratio_list):
+        edges, distances = knn_edges(ann_neighbor_indices, ann_distances, max_edges, partgraph_ratio=partgraph_ratio)
+        arrays[f'edges_{partgraph_ratio}'] = edges
+        arrays[f'distances_{partgraph_ratio}'] = distances
+        logger.info(f'graph partgraph_ratio={partgraph_ratio}: {len(edges)} edges')
+    logger.info(f'sweep graphs built:\t{time.time() - time_start}s')
+    if marker_scorer is not None:
+        arrays['marker_contigs'] = marker_scorer.contig_index
+        arrays['marker_genes'] = marker_scorer.gene_index
+        arrays['marker_num_genes'] = np.array([marker_scorer.num_genes])
+        if marker_scorer.hit_index is not None:
+            arrays['marker_hits'] = marker_scorer.hit_index
+    # ratio-major order, so workers mostly stay on the graph they already built
+    graph_params = list(dict.fromkeys((max_edges, partgraph_ratio, bandwidth)
+                                      for partgraph_ratio in partgraph_ratio_list for bandwidth in bandwidth_list))
+    window = max(1, patience) if marker_scorer is not None else len(resolution_list)
+    trackers = {params: PlateauTracker(patience=patience) for params in graph_params}
+    submitted = {params: 0 for params in graph_params}
+    # per graph, results waiting for the earlier resolutions before entering the plateau check
+    arrived = {params: {} for params in graph_params}
+    next_index = {params: 0 for params in graph_params}
+
+    def next_graph():
+        # first graph with a resolution left and fewer than `window` resolutions ahead of its plateau check
+        for params in graph_params:
+            if (submitted[params] < len(resolution_list) and submitted[params] - next_index[params] < window
+                    and not (marker_scorer is not None and trackers[params].stopped)):
+                return params
+        return None
+
+    finished = queue.Queue()
+    num_processes = max(1, min(num_workers, len(graph_params) * min(window, len(resolution_list))))
+    results = {}
+    with SharedArrays(arrays) as shared, \
+            multiprocessing.Pool(num_processes, initializer=attach_shared_arrays,
+                                 initargs=(shared.specs,)) as pool:
+        in_flight = 0
+        while True:
+            params = next_graph()
+            while params is not None and in_flight < num_processes:
+                i = submitted[params]
+                pool.apply_async(_sweep_task, params + (resolution_list[i],),
+                                 callback=lambda r, i=i: finished.put((i, r, None)),
+                                 error_callback=lambda e: finished.put((None, None, e)))
+                submitted[params] += 1
+                in_flight += 1
+                params = next_graph()
+            if not in_flight:
+                break
+            i, result, error = finished.get()
+            in_flight -= 1
+            if error is not None:
+                raise error
+            params, resolution_parameter, labels, score = result
+            if marker_scorer is None:
+                results[params + (resolution_parameter,)] = labels
+                continue
+            # feed the plateau check in resolution order, whatever order the tasks finish in
+            arrived[params][i] = (resolution_parameter, labels, score)
+            tracker = trackers[params]
+            while next_index[params] in arrived[params] and not tracker.stopped:
+                tracker.update(*arrived[params].pop(next_index[params]))
+                next_index[params] += 1
+    if marker_scorer is not None:
+        for params, tracker in trackers.items():
+            logger.info(f'graph {params}: ran {submitted[params]}/{len(resolution_list)} resolutions, '
+                        f'scored {len(tracker.history)}, best {tracker.best_key}')
+            if tracker.best_key is not None:
+                results[params + (tracker.best_key,)] = tracker.best_labels
+    return results
+
+def leiden_tuning(namelist, contig_path, latent, output_path, cache_dir=None, hmmout=None, patience=2):
     import multiprocessing
 
     # Create a logger instance
@@ -281,41 +502,49 @@ def leiden_tuning(namelist, contig_path, latent, output_path):
 
     num_workers = 240
     norm_embeddings = normalize(latent)
+    length_weight = get_length_weight(namelist)
     contig_length_threshold = 1000
     marker_name = "bacar_marker"
     quarter="2quarter"
 
     seed_file = gen_seed(logger, contig_path, num_workers, contig_length_threshold,
              marker_name, quarter)
+    # score candidates in-process on single-copy markers instead of running CheckM on every partition
+    marker_scorer = MarkerScorer.from_hmmout(hmmout, namelist) if hmmout is not None else None
     ##### #########  hnswlib_method
     parameter_list = [1, 5,10,30,50,70, 90, 110]
     bandwidth_list = [0.05, 0.1,0.15, 0.2,0.3]
     partgraph_ratio_list =[50,100,80]
     max_edges_list = [100]
     for max_edges in max_edges_list:
-        p = fit_hnsw_index(logger, norm_embeddings, num_workers, ef=max_edges * 10)
         seed_bacar_marker_idx = gen_seed_idx(seed_file, contig_id_list=namelist)
-        initial_list = list(np.arange(len(namelist)))
-        is_membership_fixed = [i in seed_bacar_marker_idx for i in initial_list]
+        is_membership_fixed = np.zeros(len(namelist), dtype=bool)
+        is_membership_fixed[seed_bacar_marker_idx] = True
 
         time_start = time.time()
-        ann_neighbor_indices, ann_distances = p.knn_query(norm_embeddings, max_edges+1, num_threads=num_workers)
+        ann_neighbor_indices, ann_distances = cached_knn(norm_embeddings, max_edges + 1, num_workers,
+                                                         cache_dir=cache_dir or os.path.dirname(output_path) or '.',
+                                                         ef=max_edges * 10)
         #ann_distances is l2 distance's square
         time_end = time.time()
         logger.info('knn query time cost:\t' +str(time_end - time_start) + "s")
 
-        with multiprocessing.Pool(num_workers) as multiprocess:
-            for partgraph_ratio in partgraph_ratio_list:
-                for bandwidth in bandwidth_list:
-                    for para in parameter_list:
-                        output_file = output_path + 'Leiden_bandwidth_' + str(
-                            bandwidth) + '_res_maxedges' + str(max_edges) + 'respara_'+str(para)+'_partgraph_ratio_'+str(partgraph_ratio)+'.tsv'
-
-                        if not (os.path.exists(output_file)):
-                            multiprocess.apply_async(run_leiden, (output_file, namelist, ann_neighbor_indices, ann_distances, length_weight, max_edges, norm_embeddings,
-                                                                        bandwidth, 'l2', initial_list,is_membership_fixed,
-                                                                        para, partgraph_ratio))
-
-            multiprocess.close()
-            multiprocess.join()
-        logger.info('multiprocess Done')
+        results = leiden_sweep(ann_neighbor_indices, ann_distances, length_weight, max_edges,
+                               partgraph_ratio_list, bandwidth_list, parameter_list,
+                               is_membership_fixed=is_membership_fixed, num_workers=num_workers,
+                               marker_scorer=marker_scorer, patience=patience)
+        if marker_scorer is not None:
+            # every graph returned its best resolution, keep the overall winner only
+            best_params, best_labels, _ = select_partition(sorted(results.items()), marker_scorer,
+                                                           patience=len(results))
+            logger.info(f'best partition {best_params}: {marker_scorer.summary(best_labels)}')
+            with open(output_path + 'Leiden_best_maxedges' + str(max_edges) + '.tsv', 'w') as f:
+                for contig_name, ci in zip(namelist, best_labels):
+                    f.write(str(contig_name) + "\t" + 'group' + str(ci) + "\n")
+            continue
+        params = sorted(results)
+        np.savez(output_path + 'Leiden_sweep_maxedges' + str(max_edges) + '.npz',
+                 contignames=np.asarray(namelist),
+                 params=np.asarray(params, dtype=np.float64),
+                 labels=np.stack([results[param] for param in params]))
+        logger.info('Leiden sweep done')
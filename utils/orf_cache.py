@@ -0,0 +1,81 @@
+import hashlib
+import os
+import sqlite3
+
+
+def sequence_key(seq, orf_finder):
+    """Content address of a contig for one ORF finder: the digest of its upper-cased sequence."""
+    return orf_finder + ':' + hashlib.blake2b(seq.upper().encode(), digest_size=16).hexdigest()
+
+
+class OrfCache:
+    """Persistent store of predicted proteins per contig sequence.
+
+    Prodigal (-p meta) and FragGeneScan predict every contig on its own, so
+    the proteins of a contig only depend on its sequence and can be reused by
+    any later run on an assembly or bin that contains the same sequence.
+    Proteins are stored with the contig name cut from their headers, e.g.
+    '>_1 # 2 # 301 # 1 # ...' for '>NODE_1_1 # 2 # 301 # 1 # ...', and get the
+    contig name of the current run back when read.
+
+    Args:
+        path (string): sqlite database, created when missing.
+    """
+    _BATCH = 500
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS orfs (key TEXT PRIMARY KEY, proteins TEXT NOT NULL)')
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def known(self, keys):
+        """Subset of keys that are cached."""
+        keys = list(set(keys))
+        found = set()
+        for start in range(0, len(keys), self._BATCH):
+            batch = keys[start:start + self._BATCH]
+            rows = self.connection.execute(
+                f'SELECT key FROM orfs WHERE key IN ({",".join("?" * len(batch))})', batch)
+            found.update(key for key, in rows)
+        return found
+
+    def get_many(self, keys):
+        """Cached proteins of the given keys.
+
+        Returns:
+            proteins (dict): key -> stored protein records, for cached keys only.
+        """
+        keys = list(set(keys))
+        found = {}
+        for start in range(0, len(keys), self._BATCH):
+            batch = keys[start:start + self._BATCH]
+            rows = self.connection.execute(
+                f'SELECT key, proteins FROM orfs WHERE key IN ({",".join("?" * len(batch))})', batch)
+            found.update(rows)
+        return found
+
+    def put_many(self, items):
+        """Stores (key, protein records) pairs; an empty string marks a contig without ORFs."""
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO orfs (key, proteins) VALUES (?, ?)', items)
+
+    @staticmethod
+    def strip_name(records, name):
+        """Cuts the contig name from the headers of its protein records."""
+        return ''.join('>' + line[1 + len(name):] if line.startswith('>') else line
+                       for line in records.splitlines(keepends=True))
+
+    @staticmethod
+    def restore_name(records, name):
+        """Puts the contig name of the current run back into stored headers."""
+        return ''.join('>' + name + line[1:] if line.startswith('>') else line
+                       for line in records.splitlines(keepends=True))
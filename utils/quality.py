@@ -0,0 +1,285 @@
+import re
+import numpy as np
+import pandas as pd
+from utils.calculate_bin_num import normalize_marker_trans__dict
+from utils.constraints import index_of
+
+MARKER_TABLE = 'markers.tsv'
+_VIEW_SUFFIX = re.compile(r'_aug_\d+(_newid_\d+)?$')
+
+
+def strip_view_suffix(name):
+    """Maps a multiview contig name (..._aug_k_newid_i) back to the assembly contig name."""
+    return _VIEW_SUFFIX.sub('', str(name))
+
+
+def read_marker_table(hmmout, orf_finder='prodigal', min_coverage=0.4):
+    """Reads single-copy marker hits from a hmmsearch domtblout.
+
+    Applies the same filtering as get_marker: marker names are normalised,
+    hits must cover more than min_coverage of the query and every
+    (gene, contig) pair is kept once.
+
+    Args:
+        hmmout (string): path of markers.hmmout.
+        orf_finder (string): 'prodigal' or 'fraggenescan', decides how ORF
+            names map back to contigs.
+        min_coverage (float): minimal (qend - qstart) / qlen of a hit.
+
+    Returns:
+        table (pd.DataFrame): columns 'contig', 'gene', 'qlen' (marker
+            model length) and 'coverage' of the first hit of every pair.
+    """
+    data = pd.read_table(hmmout, sep=r'\s+', comment='#', header=None,
+                         usecols=(0, 3, 5, 15, 16), names=['orf', 'gene', 'qlen', 'qstart', 'qend'])
+    if not len(data):
+        return pd.DataFrame({'contig': [], 'gene': [], 'qlen': [], 'coverage': []})
+    data['gene'] = data['gene'].map(lambda m: normalize_marker_trans__dict.get(m, m))
+    coverage = (data['qend'] - data['qstart']) / data['qlen']
+    data, coverage = data[coverage > min_coverage], coverage[coverage > min_coverage]
+    splits = 1 if orf_finder == 'prodigal' else 3
+    contig = data['orf'].str.rsplit('_', n=splits).str[0]
+    table = pd.DataFrame({'contig': contig.values, 'gene': data['gene'].values,
+                          'qlen': data['qlen'].values, 'coverage': coverage.values})
+    return table.drop_duplicates(['contig', 'gene'], ignore_index=True)
+
+
+def write_marker_table(hmmout, path, contignames=None, orf_finder='prodigal'):
+    """Saves the genome-wide marker hits once, for reuse by every bin.
+
+    Args:
+        hmmout (string): markers.hmmout of the whole assembly.
+        path (string): output tsv, usually <outdir>/markers.tsv.
+        contignames (array-like): contigs kept by preprocessing; their index
+            is stored as 'contig_index' (-1 for filtered contigs).
+        orf_finder (string): see read_marker_table.
+
+    Returns:
+        table (pd.DataFrame): columns 'contig_index', 'contig', 'gene',
+            'qlen' and 'coverage'.
+    """
+    table = read_marker_table(hmmout, orf_finder=orf_finder)
+    contig_index = -np.ones(len(table), dtype=np.int64) if contignames is None else index_of(contignames, table['contig'])
+    table.insert(0, 'contig_index', contig_index)
+    table.to_csv(path, sep='\t', index=False)
+    return table
+
+
+def load_marker_table(path):
+    """Reads a table written by write_marker_table."""
+    return pd.read_table(path, dtype={'contig': str, 'gene': str})
+
+
+def subset_marker_table(table, contignames):
+    """Marker hits of a set of contigs, e.g. one bin, without rerunning hmmsearch.
+
+    Names are matched on the assembly contig name, so view names select the
+    hits of their contig; a contig listed several times gets its hits on the
+    first occurrence only.
+
+    Args:
+        table (pd.DataFrame): genome-wide table, see write_marker_table.
+        contignames (array-like): contigs of the subset.
+
+    Returns:
+        table (pd.DataFrame): hits of the subset, with a 'row' column indexing
+            contignames.
+    """
+    rows = index_of([strip_view_suffix(name) for name in contignames],
+                    [strip_view_suffix(name) for name in table['contig']])
+    subset = table[rows >= 0].copy()
+    subset['row'] = rows[rows >= 0]
+    return subset.reset_index(drop=True)
+
+
+class MarkerScorer:
+    """Scores partitions by single-copy marker completeness and contamination.
+
+    Marker hits are stored as integer (row, gene) codes, so a partition is
+    scored with a single bincount over the hits. Completeness of a bin is the
+    fraction of marker genes it contains, contamination the number of extra
+    copies over the number of marker genes, as in CheckM.
+
+    When rows are views of the same contig (multiview names), a hit is listed
+    once per view row with the same hit_index, and counted once per bin.
+
+    Args:
+        contig_index (np.ndarray): row of every marker hit, (H,).
+        gene_index (np.ndarray): gene code of every marker hit, (H,).
+        num_genes (int): size of the marker set.
+        hit_index (np.ndarray): id of the (contig, gene) hit every entry
+            comes from, (H,); None when every entry is a distinct hit.
+    """
+    def __init__(self, contig_index, gene_index, num_genes=None, hit_index=None):
+        self.contig_index = np.asarray(contig_index, dtype=np.int64)
+        self.gene_index = np.asarray(gene_index, dtype=np.int64)
+        self.hit_index = None if hit_index is None else np.asarray(hit_index, dtype=np.int64)
+        if num_genes is None:
+            num_genes = int(self.gene_index.max()) + 1 if len(self.gene_index) else 0
+        self.num_genes = int(num_genes)
+
+    @classmethod
+    def from_hmmout(cls, hmmout, contignames, orf_finder='prodigal'):
+        """Builds the scorer from markers.hmmout for the given row order.
+
+        Hits and rows are matched on the assembly contig name, so a hmmout
+        of the combined multiview FASTA counts every (contig, gene) once, and
+        a contig with several view rows in contignames has its hits on each
+        of them. Hits on contigs that are not in contignames are dropped.
+        """
+        return cls.from_table(read_marker_table(hmmout, orf_finder=orf_finder), contignames)
+
+    @classmethod
+    def from_table(cls, table, contignames):
+        """Builds the scorer from a marker table, see read_marker_table and load_marker_table."""
+        table = pd.DataFrame({'contig': [strip_view_suffix(name) for name in table['contig']],
+                              'gene': table['gene'].values}).drop_duplicates(ignore_index=True)
+        gene_codes, genes = pd.factorize(table['gene'])
+        row_codes, contigs = pd.factorize(pd.Index([strip_view_suffix(name) for name in contignames]))
+        hit_contig = contigs.get_indexer(table['contig'])
+        found = np.flatnonzero(hit_contig >= 0)
+        hit_contig = hit_contig[found]
+
+        # rows of every contig, grouped: rows_by_contig[starts[c]:starts[c] + counts[c]]
+        rows_by_contig = np.argsort(row_codes, kind='stable')
+        counts = np.bincount(row_codes, minlength=len(contigs))
+        starts = np.cumsum(counts) - counts
+        repeats = counts[hit_contig]
+        hit_index = np.repeat(found, repeats)
+        within = np.arange(repeats.sum()) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+        rows = rows_by_contig[np.repeat(starts[hit_contig], repeats) + within]
+        multiview = bool((counts > 1).any())
+        return cls(rows, gene_codes[hit_index], num_genes=len(genes),
+                   hit_index=hit_index if multiview else None)
+
+    def bin_quality(self, labels):
+        """Completeness and contamination of every bin of a partition.
+
+        Args:
+            labels (np.ndarray): bin label of every contig, dimension is (N,).
+
+        Returns:
+            bins (np.ndarray): bin labels, (B,).
+            completeness (np.ndarray): (B,).
+            contamination (np.ndarray): (B,).
+        """
+        bins, codes = np.unique(np.asarray(labels), return_inverse=True)
+        if self.num_genes == 0:
+            zeros = np.zeros(len(bins))
+            return bins, zeros, zeros
+        hit_bins = codes[self.contig_index]
+        gene_index = self.gene_index
+        if self.hit_index is not None:
+            # views of one contig in the same bin carry a single copy of its markers
+            _, first = np.unique(hit_bins * (int(self.hit_index.max()) + 1) + self.hit_index, return_index=True)
+            hit_bins, gene_index = hit_bins[first], gene_index[first]
+        counts = np.bincount(hit_bins * self.num_genes + gene_index,
+                             minlength=len(bins) * self.num_genes).reshape(len(bins), self.num_genes)
+        present = (counts > 0).sum(axis=1)
+        completeness = present / self.num_genes
+        contamination = (counts.sum(axis=1) - present) / self.num_genes
+        return bins, completeness, contamination
+
+    def summary(self, labels):
+        """Counts of high (>90% / <5%) and medium (>50% / <10%) quality bins and the score."""
+        _, completeness, contamination = self.bin_quality(labels)
+        return {
+            'hq': int(((completeness > 0.9) & (contamination < 0.05)).sum()),
+            'mq': int(((completeness > 0.5) & (contamination < 0.1)).sum()),
+            'score': self.score(labels),
+        }
+
+    def score(self, labels):
+        """Sum of completeness - 5 * contamination over bins above 50% / below 10%."""
+        _, completeness, contamination = self.bin_quality(labels)
+        keep = (completeness > 0.5) & (contamination < 0.1)
+        return float((completeness[keep] - 5 * contamination[keep]).sum())
+
+
+def estimate_bin_quality(table, bin_dict):
+    """In-process completeness and contamination of every bin, in place of CheckM.
+
+    Uses the single-copy marker table, so it runs in seconds right after
+    primary clustering. Completeness and contamination are relative to the
+    marker genes found in the whole table. Records carry the CheckM field
+    names read by get_issue_bins.
+
+    Args:
+        table (pd.DataFrame): marker table, see write_marker_table.
+        bin_dict (dict): bin number -> contig names.
+
+    Returns:
+        records (list): one dict per bin with 'Bin Id' ('cluster.<bin>'),
+            '# markers', 'Completeness' and 'Contamination' (percentages).
+    """
+    contignames = [contig for contigs in bin_dict.values() for contig in contigs]
+    labels = np.repeat(np.arange(len(bin_dict)), [len(contigs) for contigs in bin_dict.values()])
+    scorer = MarkerScorer.from_table(table, contignames)
+    bins, completeness, contamination = scorer.bin_quality(labels)
+    keys = list(bin_dict.keys())
+    return [{'Bin Id': f'cluster.{keys[b]}', '# markers': scorer.num_genes,
+             'Completeness': 100 * comp, 'Contamination': 100 * cont}
+            for b, comp, cont in zip(bins, completeness, contamination)]
+
+
+def write_quality_report(records, path):
+    """Saves estimate_bin_quality records as a tsv."""
+    pd.DataFrame(records).to_csv(path, sep='\t', index=False, float_format='%.2f')
+
+
+class PlateauTracker:
+    """Tracks the best scoring candidate and detects a quality plateau.
+
+    Patience only counts once some bin scored, so a leading run of
+    partitions without any medium quality bin does not stop the search.
+
+    Args:
+        patience (int): number of consecutive candidates without an
+            improvement larger than min_delta before stopping.
+        min_delta (float): minimal score improvement.
+    """
+    def __init__(self, patience=2, min_delta=1e-6):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best_key, self.best_labels, self.best_score = None, None, -np.inf
+        self.history = []
+        self.stale = 0
+
+    @property
+    def stopped(self):
+        return self.stale >= self.patience
+
+    def update(self, key, labels, score):
+        """Records the next candidate in order, returns True once the score plateaued."""
+        self.history.append((key, score))
+        if score > self.best_score + self.min_delta:
+            self.best_key, self.best_labels, self.best_score = key, labels, score
+            self.stale = 0
+        elif self.best_score > 0:
+            self.stale += 1
+        return self.stopped
+
+
+def select_partition(candidates, scorer, patience=2, min_delta=1e-6):
+    """Picks the best scoring partition, stopping once the score plateaus.
+
+    Candidates are consumed lazily, so partitions after the plateau are never
+    computed. See PlateauTracker for the stopping rule.
+
+    Args:
+        candidates (iterable): (key, labels) pairs, e.g. resolutions in order.
+        scorer (MarkerScorer): partition scorer.
+        patience (int): number of consecutive candidates without an
+            improvement larger than min_delta before stopping.
+        min_delta (float): minimal score improvement.
+
+    Returns:
+        best_key: key of the winning partition.
+        best_labels (np.ndarray): labels of the winning partition.
+        history (list): (key, score) of every evaluated candidate.
+    """
+    tracker = PlateauTracker(patience=patience, min_delta=min_delta)
+    for key, labels in candidates:
+        if tracker.update(key, labels, scorer.score(labels)):
+            break
+    return tracker.best_key, tracker.best_labels, tracker.history
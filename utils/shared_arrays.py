@@ -0,0 +1,83 @@
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+
+# arrays attached in this (worker) process, see attach_shared_arrays
+_ATTACHED = {}
+_BLOCKS = []
+
+
+class SharedArrays:
+    """Numpy arrays copied once into shared memory blocks for a process pool.
+
+    The owner creates the blocks and unlinks them on exit; workers only get
+    the small specs and map the blocks without copying. Used as a context
+    manager around the pool::
+
+        with SharedArrays({'latent': latent}) as shared:
+            with Pool(n, initializer=attach_shared_arrays, initargs=(shared.specs,)) as pool:
+                ...
+
+    Args:
+        arrays (dict): name -> numpy array.
+    """
+    def __init__(self, arrays):
+        self.blocks, self.specs = [], {}
+        try:
+            for name, array in arrays.items():
+                self.add(name, array)
+        except BaseException:
+            self.close()
+            raise
+
+    def add(self, name, array):
+        """Copies one more array into shared memory, returns its spec."""
+        array = np.ascontiguousarray(array)
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.blocks.append(block)
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        self.specs[name] = (block.name, array.shape, array.dtype.str)
+        return self.specs[name]
+
+    def close(self):
+        """Releases and unlinks every block."""
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def attach_shared_arrays(specs):
+    """Maps shared arrays into this process, e.g. as a Pool initializer.
+
+    Args:
+        specs (dict): name -> spec, see SharedArrays.specs.
+    """
+    for name, (block_name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        if multiprocessing.get_start_method() != 'fork':
+            # the owner unlinks the blocks, keep this process's own tracker from unlinking them at exit
+            # (forked workers share the owner's tracker, which already tracks them)
+            resource_tracker.unregister(block._name, 'shared_memory')
+        _BLOCKS.append(block)
+        _ATTACHED[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+
+
+def shared_array(name):
+    """Array attached under name in this process.
+
+    Raises:
+        KeyError: when no array of that name is attached.
+    """
+    return _ATTACHED[name]
+
+
+def has_shared_array(name):
+    """Whether an array of that name is attached in this process."""
+    return name in _ATTACHED
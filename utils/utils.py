@@ -17,17 +17,19 @@ from sklearn.semi_supervised import LabelPropagation
 from sklearn.utils.extmath import safe_sparse_dot
 from sklearn.exceptions import ConvergenceWarning
 import warnings
-from sklearn.mixture import GaussianMixture
 # for speed(covariance matrix error) -> fit_gmm()
 # from pycave.bayes import GaussianMixture
 import os
 import logging
 import pprint
 import sys
+import contextlib
 from torch.optim import AdamW
 from torch.optim.lr_scheduler import CosineAnnealingLR
 import torch.nn as nn
 import pandas as pd
+from utils.bin_writer import read_bin_map, write_bins
+from utils.gmm import StreamingGMM
 
 
 class Gaussian:
@@ -1009,70 +1011,53 @@ class lbp(LabelPropagation):
         self.transduction_ = transduction.ravel()
         return self.transduction_
 
-def fit_gmm(latents, contignames, output_csv_path, num_bins):
+def fit_gmm(latents, contignames, output_csv_path, num_bins, covariance_type='diag', init_resp=None,
+            num_threads=None, chunk_size=65536, max_iter=100, random_state=2021):
+    """Fits a diagonal Gaussian mixture by streaming EM and writes gmm.csv.
 
-    gmm = GaussianMixture(n_components=num_bins, random_state=2021)
+    See utils.gmm.StreamingGMM; the latents may be memory-mapped.
 
-    # config = GaussianMixtureModelConfig(num_components=2, num_features=3, covariance_type="full")
-
-    # pycave[
-    # gmm = GaussianMixture(num_components=num_bins, covariance_type='full')
-    # ]
+    Args:
+        latents (np.ndarray): latent matrix, dimension is (N, D).
+        contignames (np.ndarray): name of every row, (N,).
+        output_csv_path (string): output '<contig>\t<bin>' file.
+        num_bins (int): number of mixture components.
+        covariance_type (string): 'diag' or 'tied' (shared diagonal).
+        init_resp (np.ndarray): initial responsibilities, e.g. prob_cat of
+            every row, (N, num_bins); k-means++ when None.
+        num_threads (int): torch threads, unchanged when None.
+        chunk_size (int): number of rows per chunk.
+        max_iter (int): maximal number of EM iterations.
+        random_state (int): seed of the k-means++ initialisation.
 
-    predicts = gmm.fit_predict(latents)
-    # print(num_bins)
-    # predic_probs = gmm.predict_proba(latents)
-    # max_predic_probs = np.max(predic_probs, axis=1)
+    Returns:
+        predicts (np.ndarray): bin of every row, (N,).
+    """
+    previous_threads = torch.get_num_threads()
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    try:
+        gmm = StreamingGMM(num_bins, covariance_type=covariance_type, max_iter=max_iter,
+                           chunk_size=chunk_size, random_state=random_state)
+        predicts = gmm.fit(latents, init_resp=init_resp).predict(latents)
+    finally:
+        torch.set_num_threads(previous_threads)
 
     with open(output_csv_path, 'w') as f:
         for contig, cluster in zip(contignames, predicts):
             # f.write(f'{cluster}\t{contig}\n')
             f.write(f'{contig}\t{cluster}\n')
+    return predicts
 
-def get_binning_result(contig_path, cluster_result, out):
-    contigs = contig_path
-    contigs_file = open(contigs, 'r')
-    contigs_map = {}
-    header = ""
-    content = ""
-    for line in contigs_file:
-        if line == "": continue
-        if line[0] == '>':
-            if header != "": contigs_map[header] = content
-            # if len(sys.argv) == 5 and sys.argv[4] == 'idonly':
-            #     header = '_'.join(line.split('_')[:2])[1:]
-            # else:
-            header = '_'.join(line.split('_')[:2])
-            header = line.split()[0][1:]
-            content = ""
-        else: content += line.strip()
-    contigs_map[header] = content
-    contigs_file.close()
-
-    bin_map = {}
-    cluster = cluster_result
-    cluster_file = open(cluster, 'r')
-    for line in cluster_file:
-        if line == "": continue
-        if ',' in line:
-            items = line.strip().split(',')
-        else:
-            items = line.strip().split()
-        if items[1] not in bin_map: bin_map[items[1]] = []
-        bin_map[items[1]].append(items[0])
-    cluster_file.close()
-
-
-    output = out
-    if not os.path.isdir(output):
-        os.system(f"mkdir {output}")
-    for file in os.listdir(output):
-        if ".fasta" in file: os.system("rm " + output + '/' + file)
-    for bin in bin_map:
-        out = open(output + "/cluster." + bin + ".fasta", 'w')
-        for header in bin_map[bin]:
-            out.write('>' + header + '\n' + contigs_map[header] + '\n')
-        out.close()
+def get_binning_result(contig_path, cluster_result, out, single_file=False):
+    """Writes the bins of a '<contig> <bin>' file as FASTA, see utils.bin_writer.write_bins.
+
+    Raises:
+        KeyError: when contigs of the binning are not in the assembly.
+    """
+    missing = write_bins(contig_path, read_bin_map(cluster_result), out, single_file=single_file)
+    if missing:
+        raise KeyError(f"{len(missing)} binned contigs not in {contig_path}, e.g. {missing[:5]}")
           
 
 
@@ -1154,6 +1139,48 @@ def _optimizer(model: nn.Module, lr: float, weight_decay: float, epoch: int):
     scheduler = CosineAnnealingLR(optimizer, T_max=epoch/2)
     return scheduler, optimizer
 
+def autocast_context(precision: str = "fp32"):
+    """Returns the autocast context used around forward and loss computation.
+
+    Args:
+        precision (string): 'fp32' runs everything in float32, 'bf16' enables
+            CPU autocast to bfloat16 for the matmul heavy layers.
+
+    Returns:
+        context manager to wrap the training step with.
+    """
+    if precision == "bf16":
+        return torch.autocast(device_type="cpu", dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+def precision_parity(model, batch, precision: str = "bf16"):
+    """Compares the total loss of one batch between fp32 and the given precision.
+
+    Both passes run in eval mode under the same RNG state, so gumbel and
+    reparameterisation noise are identical and the difference is only due to
+    the reduced precision.
+
+    Args:
+        model (DeepMetaBinModel): model to evaluate.
+        batch (dictionary): batch from the training dataloader.
+        precision (string): precision to compare against fp32.
+
+    Returns:
+        fp32_loss (float): total loss in float32.
+        low_loss (float): total loss under the requested precision.
+    """
+    was_training = model.training
+    model.eval()
+    losses = []
+    with torch.no_grad():
+        for mode in ("fp32", precision):
+            with torch.random.fork_rng(devices=[]):
+                torch.manual_seed(0)
+                with autocast_context(mode):
+                    losses.append(float(model.training_step(batch, 0)["loss"]["total"]))
+    model.train(was_training)
+    return losses[0], losses[1]
+
 def coverage_score(path):
     df = pd.read_csv(path, sep='\t', header=None, names=['contig', 'cluster'])
 